@@ -1,5 +1,9 @@
 import math
 import threading
+import itertools
+import asyncio
+import copy
+import uuid
 from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import json
@@ -8,8 +12,15 @@ from server import PromptServer
 from comfy.utils import ProgressBar, set_progress_bar_global_hook
 from typing_extensions import override
 from comfy_execution.progress import ProgressHandler, NodeProgressState, PreviewImageTuple, add_progress_handler, get_progress_state
-from .utils import preview_to_base64, print_list_or_dic
+from .utils import preview_to_base64, print_list_or_dic, EncodeSettings, cached_base64_to_image, cached_base64_to_mask, decode_cache, batch_images, compile_pattern, parse_encode_overrides
+from .request_parser import parse_request_body
+from .response_writer import JsonResponseBody, StaticResponse, write_json_body, negotiate_encoding, compress_body, COMPRESS_MIN_SIZE
+from .result_cache import ResultCache
+from .request_coalescer import RequestCoalescer
+from .metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE, SIZE_BUCKETS
+from .api_server_async import OpenOutpainterAsyncServer, register_prompt_server_routes, prompt_server_cors_enabled
 import nodes
+import execution
 
 # API POST endpoints that are handled by nodes
 class POSTPATHS:
@@ -19,58 +30,427 @@ class POSTPATHS:
     PATH_IMG2IMG = '/sdapi/v1/img2img'
     PATH_OPTIONS = '/sdapi/v1/options/'
 
-VALID_POST_PATHS = [
-    POSTPATHS.PATH_UPSCALE,
-    POSTPATHS.PATH_INTERROGATE,
-    POSTPATHS.PATH_TXT2IMG,
-    POSTPATHS.PATH_IMG2IMG,
-    POSTPATHS.PATH_OPTIONS,
+# server-sent events stream of progress, not part of the A1111 api
+PATH_PROGRESS_STREAM = '/openoutpaint/v1/progress-stream'
+
+# bodies of rejected POSTs up to this size are read and dropped to keep the connection alive,
+# bigger ones are cheaper to drop by closing the connection
+MAX_DISCARD_BODY_SIZE = 1 << 20
+
+# HTTP front ends the API can be served with
+class SERVERMODES:
+    THREADING = "threading" # ThreadingHTTPServer, one blocked thread per open request
+    ASYNCIO = "asyncio" # aiohttp on its own event loop, open requests wait on futures
+    PROMPTSERVER = "comfyui" # routes mounted on ComfyUI's own server and port, no extra listener
+
+VALID_SERVER_MODES = [
+    SERVERMODES.THREADING,
+    SERVERMODES.ASYNCIO,
+    SERVERMODES.PROMPTSERVER,
 ]
 
+# how API requests get the workflow queued
+class SUBMITMODES:
+    WEBUI = "webui" # ask the ComfyUI browser tab to queue the workflow, so user can interact with it
+    HEADLESS = "headless" # queue a captured copy of the workflow directly, no browser needed
 
-class ProgressData:
+VALID_SUBMIT_MODES = [
+    SUBMITMODES.WEBUI,
+    SUBMITMODES.HEADLESS,
+]
+
+
+# lifecycle of an OpenOutpainterRequest
+class REQUESTSTATES:
+    QUEUED = "queued" # waiting for the workflow to pick it up
+    RUNNING = "running" # serving node handed it to the workflow
+    FINISHED = "finished" # output ready, response not yet sent
+    FAILED = "failed" # finalized with an error status, eg. timed out
+
+VALID_REQUEST_STATES = [
+    REQUESTSTATES.QUEUED,
+    REQUESTSTATES.RUNNING,
+    REQUESTSTATES.FINISHED,
+    REQUESTSTATES.FAILED,
+]
+
+
+##################
+#     Routes     #
+##################
+# every endpoint is a Route in one dict keyed by (method, normalized path),
+# trailing slashes are ignored both when registering and looking up.
+# GET routes are registered at the bottom of this file, POST routes that run the workflow
+# are registered by the node modules that answer them (nodes_txt2img etc.).
+# Both front ends report every finished request to RouteRegistry.record.
+
+class ROUTEKINDS:
+    GET = "get" # answered by handler(manager, url)
+    STATIC = "static" # GET pre-serialized by update_static_responses, handler(manager, url) only runs then
+    STREAM = "stream" # GET that keeps the connection open, handled by the front end
+    TEXT = "text" # GET answered by handler(manager, url) with plain text instead of JSON
+    IMMEDIATE = "immediate" # POST answered by handler(manager, data) without running the workflow
+    WORKFLOW = "workflow" # POST queued as an OpenOutpainterRequest for the workflow
+
+http_requests_total = metrics.counter("oop_http_requests_total", "Finished HTTP requests", ("method", "path", "status"))
+http_request_duration_seconds = metrics.histogram("oop_http_request_duration_seconds", "Time from receiving a request to finishing its reply", ("method", "path"))
+http_response_bytes_total = metrics.counter("oop_http_response_bytes_total", "Response body bytes sent", ("method", "path"))
+http_response_size_bytes = metrics.histogram("oop_http_response_size_bytes", "Response body size", ("method", "path"), SIZE_BUCKETS)
+open_requests_gauge = metrics.gauge("oop_open_requests", "Requests waiting for or running in the workflow", ("path",))
+request_states_gauge = metrics.gauge("oop_requests_by_state", "Open requests by state", ("state",))
+cache_gauge = metrics.gauge("oop_cache", "Decode and result cache stats", ("cache", "stat"))
+queue_wait_seconds = metrics.histogram("oop_queue_wait_seconds", "Time from a request being queued to the workflow picking it up", ("path",))
+
+def normalize_path(path):
+    return path.rstrip('/') or '/'
+
+class Route:
+    def __init__(self, method, path, kind, handler = None, compress = False, blocking = False):
+        self.method = method
+        self.path = path # as registered, requests are created with this path so nodes can compare against it
+        self.kind = kind
+        self.handler = handler
+        self.compress = compress # gzip/deflate the reply if the client accepts it
+        self.blocking = blocking # handler can take a while, the asyncio front ends run it in an executor
+        self.count = 0
+        self.errors = 0 # replies with status >= 400
+        self.total_time = 0.0
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "average_duration": self.total_time / self.count if self.count else None,
+        }
+
+class RouteRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {} # (method, normalized path): Route
+        self.unmatched = 0
+
+    def add(self, method, path, kind, handler = None, compress = False, blocking = False):
+        route = Route(method, path, kind, handler, compress, blocking)
+        self.routes[(method, normalize_path(path))] = route
+        return route
+
+    def resolve(self, method, path):
+        return self.routes.get((method, normalize_path(path)))
+
+    def paths(self, method, kind = None):
+        return [route.path for route in self.routes.values() if route.method == method and (kind is None or route.kind == kind)]
+
+    # decorator for GET handlers
+    def get(self, path, kind = ROUTEKINDS.GET, compress = False, blocking = False):
+        def register(handler):
+            self.add("GET", path, kind, handler, compress, blocking)
+            return handler
+        return register
+
+    # decorator for POST handlers that don't need the workflow
+    def post(self, path):
+        def register(handler):
+            self.add("POST", path, ROUTEKINDS.IMMEDIATE, handler)
+            return handler
+        return register
+
+    def add_workflow(self, path):
+        return self.add("POST", path, ROUTEKINDS.WORKFLOW)
+
+    # called once per finished request by both front ends, route is None if nothing matched
+    def record(self, method, route, status, duration, bytes_sent = 0):
+        path = route.path if route is not None else "unmatched"
+        http_requests_total.inc(labels=(method, path, status))
+        http_request_duration_seconds.observe(duration, (method, path))
+        http_response_bytes_total.inc(bytes_sent, (method, path))
+        http_response_size_bytes.observe(bytes_sent, (method, path))
+        with self.lock:
+            if route is None:
+                self.unmatched += 1
+                return
+            route.count += 1
+            if status is None or status >= 400:
+                route.errors += 1
+            route.total_time += duration
+
+    def stats(self):
+        with self.lock:
+            stats = {f"{route.method} {route.path}": route.stats() for route in self.routes.values() if route.count}
+            stats["unmatched"] = self.unmatched
+            return stats
+
+routes = RouteRegistry()
+
+
+# raised when an endpoint already has too many open requests
+class OpenOutpainterServerBusy(Exception):
+    def __init__(self, path, open_requests, retry_after):
+        super().__init__(f"Too many open requests for {path} ({open_requests}), retry after {retry_after}s")
+        self.path = path
+        self.retry_after = retry_after
+
+
+# raised for request bodies that parse but can't be run, answered with 400
+class OpenOutpainterBadRequest(ValueError):
+    pass
+
+
+# how latent previews are encoded for /sdapi/v1/progress
+class PreviewSettings:
     def __init__(self):
+        self.format = "PNG"
+        self.quality = 95
+        self.min_interval = 0.0 # seconds between encoding new previews, polls in between get the last one
+
+
+# progress of a single prompt
+class ProgressData:
+    def __init__(self, prompt_id = None, preview_settings = None):
+        self.prompt_id = prompt_id
+        self.preview_settings = preview_settings or PreviewSettings()
         self.preview_image = None
+        self.preview_version = 0 # bumped for every new preview image
+        self.encoded_preview = None
+        self.encoded_version = -1
+        self.encoded_time = 0
+        self.encode_lock = threading.Lock()
         self.start_time = None
+        # per node (value, max), with the sums kept up to date as nodes report progress
+        # so polls don't have to walk every node
+        self.node_progress = {}
+        self.value_sum = 0.0
+        self.max_sum = 0.0
+        self.progress_lock = threading.Lock()
 
     def store_preview_image(self, preview_image):
         if preview_image is not None:
             self.preview_image = preview_image
+            self.preview_version += 1
+
+    # preview is only re-encoded when it changed, and not more often than min_interval
+    def get_encoded_preview(self):
+        with self.encode_lock:
+            version = self.preview_version
+            if version == self.encoded_version:
+                return self.encoded_preview
+            preview_image = self.preview_image
+            if preview_image is None:
+                return None
+            now = time.time()
+            if self.encoded_preview is not None and now - self.encoded_time < self.preview_settings.min_interval:
+                return self.encoded_preview
+            settings = self.preview_settings
+            self.encoded_preview = preview_to_base64(preview_image[1], settings.format, settings.quality)
+            self.encoded_version = version
+            self.encoded_time = now
+            return self.encoded_preview
+
+    def start(self):
+        if self.start_time is None:
+            self.start_time = time.time()
+
+    def update_node(self, node_id, value, max_value):
+        value = float(value or 0)
+        max_value = float(max_value or 0)
+        with self.progress_lock:
+            old_value, old_max = self.node_progress.get(node_id, (0.0, 0.0))
+            self.node_progress[node_id] = (value, max_value)
+            self.value_sum += value - old_value
+            self.max_sum += max_value - old_max
+
+    def finish_node(self, node_id):
+        with self.progress_lock:
+            max_value = self.node_progress.get(node_id, (0.0, 1.0))[1] or 1.0
+        self.update_node(node_id, max_value, max_value)
+
+    # overall progress is weighted by each node's max, so long samplers outweigh single step nodes
+    def get_progress_sums(self):
+        with self.progress_lock:
+            return self.value_sum, self.max_sum
+
+    def get_node_progress(self):
+        with self.progress_lock:
+            return {node_id: {"value": value, "max": max_value} for node_id, (value, max_value) in self.node_progress.items()}
 
     def get_progress(self, skip_current_image):
-        progress_value = 0
-        progress_max = 0
-        nodes = get_progress_state().nodes
-        for node_id, state in nodes.items():
-            progress_value =+ state["value"]
-            progress_max =+ state["max"]
+        progress_value, progress_max = self.get_progress_sums()
         current_image = None
         progress = 0
         eta = 0
         if self.start_time is not None and progress_value > 0:
             if progress_value > 0 and self.preview_image is not None and not skip_current_image:
-                current_image = preview_to_base64(self.preview_image[1])
-            progress = progress_value / progress_max
+                current_image = self.get_encoded_preview()
+            progress = min(1.0, progress_value / progress_max)
             eta = ((time.time() - self.start_time) / progress_value) * (progress_max - progress_value)
         return progress, current_image, eta
 
     def reset(self):
         self.preview_image = None
+        self.preview_version += 1
         self.start_time = None
+        with self.progress_lock:
+            self.node_progress = {}
+            self.value_sum = 0.0
+            self.max_sum = 0.0
+
+
+# progress per prompt_id, and which prompt each API request is running in
+# so concurrent requests don't stomp on each other's progress and previews
+class ProgressTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prompts = {} # prompt_id: ProgressData
+        self.request_prompts = {} # request_id or client task_id: prompt_id
+        self.current_prompt_id = None # last prompt that started executing
+        self.preview_settings = PreviewSettings() # shared by all prompts
+        self.subscribers = {} # token: callback(prompt_id), called from the execution thread
+        self.subscriber_tokens = itertools.count()
+
+    def subscribe(self, callback):
+        token = next(self.subscriber_tokens)
+        with self.lock:
+            self.subscribers[token] = callback
+        return token
+
+    def unsubscribe(self, token):
+        with self.lock:
+            self.subscribers.pop(token, None)
+
+    # tell progress streams something changed, they work out what on their own threads
+    # so the execution thread never encodes previews for them
+    def notify(self, prompt_id = None):
+        with self.lock:
+            callbacks = list(self.subscribers.values())
+        for callback in callbacks:
+            callback(prompt_id)
+
+    def get(self, prompt_id):
+        with self.lock:
+            progress = self.prompts.get(prompt_id)
+            if progress is None:
+                progress = self.prompts[prompt_id] = ProgressData(prompt_id, self.preview_settings)
+            return progress
+
+    def start(self, prompt_id):
+        self.get(prompt_id).start()
+        self.current_prompt_id = prompt_id
+        self.notify(prompt_id)
+
+    def bind_request(self, request_id, prompt_id):
+        if prompt_id is None:
+            return
+        self.get(prompt_id)
+        with self.lock:
+            self.request_prompts[request_id] = prompt_id
+
+    # progress for a task_id or request_id, or the current prompt if request_id is None
+    # ids from query strings are strings, internal request ids are also found by their digits
+    def find(self, request_id = None):
+        with self.lock:
+            if request_id is None:
+                prompt_id = self.current_prompt_id
+            else:
+                prompt_id = self.request_prompts.get(request_id)
+                if prompt_id is None and isinstance(request_id, str) and request_id.isdigit():
+                    prompt_id = self.request_prompts.get(int(request_id))
+            return self.prompts.get(prompt_id)
+
+    # drop a finished request's progress, unless another request shares its prompt
+    def remove_request(self, request_id):
+        with self.lock:
+            prompt_id = self.request_prompts.pop(request_id, None)
+            if prompt_id is not None and prompt_id not in self.request_prompts.values():
+                self.prompts.pop(prompt_id, None)
+                if self.current_prompt_id == prompt_id:
+                    self.current_prompt_id = None
+
+    # forget prompts not belonging to any open request, eg. plain workflow runs
+    def prune(self, keep_prompt_id = None):
+        with self.lock:
+            bound = set(self.request_prompts.values())
+            for prompt_id in list(self.prompts.keys()):
+                if prompt_id not in bound and prompt_id != keep_prompt_id:
+                    del self.prompts[prompt_id]
+
+    def get_progress(self, skip_current_image, request_id = None):
+        progress = self.find(request_id)
+        if progress is None:
+            return 0, None, 0
+        return progress.get_progress(skip_current_image)
+
+    def get_node_progress(self, request_id = None):
+        progress = self.find(request_id)
+        if progress is None:
+            return {}
+        return progress.get_node_progress()
+
+
+# one client's view of a progress stream
+# only produces an event when progress or the preview changed since the last one it sent,
+# previews come from the shared per-version cache so many observers still cost one encode per update
+class ProgressStream:
+    KEEPALIVE_INTERVAL = 15 # seconds
+
+    def __init__(self, manager, request_id = None, skip_current_image = False):
+        self.manager = manager
+        self.request_id = request_id
+        self.skip_current_image = skip_current_image
+        self.last_progress = None
+        self.last_image = None
+        self.done = False
+        self.seen_request = False # the stream may be opened before the POST with its task id arrives
+
+    # request streams end once the request is answered, current prompt streams run until the client leaves
+    def is_request_done(self):
+        if self.request_id is None:
+            return False
+        request = self.manager.requests.lookup(self.request_id)
+        if request is None:
+            return self.seen_request
+        self.seen_request = True
+        return request.finalized
+
+    def next_event(self):
+        if self.done:
+            return None
+        if self.is_request_done():
+            self.done = True
+            return {"progress": 1.0, "eta_relative": 0, "current_image": None, "done": True}
+
+        progress, current_image, eta = self.manager.progress.get_progress(self.skip_current_image, self.request_id)
+        # same cached string object means the preview did not change
+        image_changed = current_image is not None and current_image is not self.last_image
+        if progress == self.last_progress and not image_changed:
+            return None
+        self.last_progress = progress
+        if image_changed:
+            self.last_image = current_image
+        return {
+            "progress": progress,
+            "eta_relative": eta,
+            "current_image": current_image if image_changed else None, # only sent when it changed
+            "done": False,
+        }
+
+    @staticmethod
+    def format_event(event):
+        return f"data: {json.dumps(event)}\n\n".encode('utf-8')
+
+    @staticmethod
+    def format_keepalive():
+        return b": keepalive\n\n"
 
 
 # Handler to get progress from ComfyUI
 class OpenOutpainterProgressHandler(ProgressHandler):
-    def __init__(self, progress: ProgressData):
+    def __init__(self, progress: ProgressTracker):
         super().__init__("openoutpainter")
         self.progress = progress
-        self.progress.reset()
 
     @override
     def start_handler(self, node_id: str, state: NodeProgressState, prompt_id: str):
-        if self.progress.start_time is None:
-            self.progress.start_time = time.time()
-        pass
+        self.progress.start(prompt_id)
+        self.progress.get(prompt_id).update_node(node_id, state.get("value", 0), state.get("max", 1))
 
     @override
     def update_handler(
@@ -82,15 +462,21 @@ class OpenOutpainterProgressHandler(ProgressHandler):
         prompt_id: str,
         image: PreviewImageTuple | None = None,
     ):
-        self.progress.store_preview_image(image)
+        progress = self.progress.get(prompt_id)
+        progress.update_node(node_id, value, max_value)
+        # new preview invalidates the cached encoding
+        progress.store_preview_image(image)
+        self.progress.notify(prompt_id)
 
     @override
     def finish_handler(self, node_id: str, state: NodeProgressState, prompt_id: str):
-        pass
+        self.progress.get(prompt_id).finish_node(node_id)
+        self.progress.notify(prompt_id)
 
     @override
     def reset(self):
-        self.progress.reset()
+        # a new prompt is starting, only keep progress of prompts open requests still care about
+        self.progress.prune()
 
 
 class OpenOutpainterRequest:
@@ -99,15 +485,204 @@ class OpenOutpainterRequest:
         self.request_data = request_data
         self.extra_data = {}
         self.path = path
+        self.prompt_id = None # only known when queued headless
+        self.task_id = None # client chosen id to follow progress with, A1111's force_task_id
+        self.created_time = time.time()
         self.output_ready = threading.Event()
         self.output = None
+        self.status = 200 # http status to respond with
+        self.state = REQUESTSTATES.QUEUED
+        self.finalized = False # unlike output_ready, never cleared again
+        self.done_callbacks = []
+        self.lock = threading.Lock()
+        self.decoded = {} # (kind, key, index): tensor, decoded on first use
+        self.members = [] # requests merged into this one by RequestCoalescer, answered from its output
+        self.cached = False # answered from ResultCache without running the workflow
+        self.counted = True # holds a slot in the registry's path_counts
+        self.decode_lock = threading.RLock() # batches decode their images through get_image
 
     def is_command(self, command):
         return self.path is not None and command == self.path
 
-    def finalize(self, result):
-        self.output = result
-        self.output_ready.set()
+    # images are only decoded the first time a node asks for them, then shared by every node
+    # and re-execution using this request, until it is finalized
+    def get_decoded(self, kind, decode, key, index = None):
+        cache_key = (kind, key, index)
+        with self.decode_lock:
+            tensor = self.decoded.get(cache_key)
+            if tensor is None:
+                data = self.request_data[key]
+                if index is not None:
+                    data = data[index]
+                tensor = self.decoded[cache_key] = decode(data)
+            return tensor
+
+    def get_image(self, key, index = None):
+        return self.get_decoded("image", cached_base64_to_image, key, index)
+
+    def get_mask(self, key = "mask"):
+        return self.get_decoded("mask", cached_base64_to_mask, key)
+
+    # every image of a list field stacked into one IMAGE batch
+    def get_image_batch(self, key):
+        return self.get_decoded(
+            "image_batch",
+            lambda data: batch_images([self.get_image(key, index) for index in range(len(data))]),
+            key,
+        )
+
+    # callback(request) is called from whatever thread finalizes the request,
+    # used by the asyncio front end to resolve futures instead of blocking a thread
+    def add_done_callback(self, callback):
+        with self.lock:
+            if not self.finalized:
+                self.done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def finalize(self, result, status = 200):
+        with self.lock:
+            self.output = result
+            self.status = status
+            self.state = REQUESTSTATES.FINISHED if status < 400 else REQUESTSTATES.FAILED
+            self.finalized = True
+            self.decoded = {}
+            self.output_ready.set()
+            callbacks = self.done_callbacks
+            self.done_callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def is_stale(self, timeout, now):
+        return not self.finalized and timeout > 0 and now - self.created_time > timeout
+
+    # output encoding set on the serving node, optionally overridden by the request
+    def get_encode_settings(self):
+        settings = self.extra_data.get("encode_settings") or EncodeSettings()
+        return settings.with_overrides(self.request_data)
+
+    # style and checkpoint switch nodes route on this instead of scanning the request each,
+    # built once per request in serve() after oop_styles is set
+    def build_routing_index(self):
+        styles = self.request_data.get("styles")
+        oop_styles = self.extra_data.get("oop_styles") or {}
+        self.extra_data["routing"] = {
+            "has_styles": styles is not None,
+            "styles": frozenset(name for name in (styles or []) if name in oop_styles),
+            "checkpoint": self.request_data.get("checkpoint", ""),
+            "checkpoint_matches": {}, # (pattern, use_regex): bool
+        }
+        return self.extra_data["routing"]
+
+    def get_routing_index(self):
+        return self.extra_data.get("routing") or self.build_routing_index()
+
+    # None if the request has no styles field at all
+    def has_style(self, style_name):
+        routing = self.get_routing_index()
+        if not routing["has_styles"]:
+            return None
+        return style_name in routing["styles"]
+
+    def checkpoint_matches(self, pattern, use_regex):
+        routing = self.get_routing_index()
+        cache_key = (pattern, use_regex)
+        matches = routing["checkpoint_matches"].get(cache_key)
+        if matches is None:
+            checkpoint = routing["checkpoint"]
+            if use_regex:
+                compiled = compile_pattern(pattern)
+                matches = compiled is not None and compiled.search(checkpoint) is not None
+            else:
+                matches = pattern == checkpoint
+            routing["checkpoint_matches"][cache_key] = matches
+        return matches
+
+    def mark_running(self):
+        with self.lock:
+            if self.finalized or self.state != REQUESTSTATES.QUEUED:
+                return
+            self.state = REQUESTSTATES.RUNNING
+        queue_wait_seconds.observe(time.time() - self.created_time, (self.path,))
+
+    # drop the request body and anything decoded from it, only the output is kept
+    def release(self):
+        self.request_data = {}
+        self.extra_data = {}
+        self.decoded = {}
+
+
+# open requests, shared between http handler threads, the reaper and the workflow
+# ids come from a single counter and every change happens under one lock,
+# iteration is always over a snapshot so handlers can remove requests at any time
+class OpenOutpainterRequestRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.ids = itertools.count()
+        self.path_counts = {} # path: open requests
+        self.task_ids = {} # task_id: request
+
+    # returns None if path already has max_per_path open requests
+    # uncounted requests (merged leaders, their members already hold the slots) skip admission and path_counts
+    def create(self, request_data, path, max_per_path = 0, counted = True):
+        with self.lock:
+            if counted and 0 < max_per_path <= self.path_counts.get(path, 0):
+                return None
+            request = OpenOutpainterRequest(next(self.ids), request_data, path)
+            request.counted = counted
+            self.requests[request.id] = request
+            task_id = request_data.get("force_task_id")
+            if task_id not in (None, ""):
+                request.task_id = str(task_id)
+                self.task_ids[request.task_id] = request
+            if counted:
+                self.path_counts[path] = self.path_counts.get(path, 0) + 1
+            return request
+
+    def get(self, request_id):
+        return self.requests.get(request_id, None)
+
+    # by the client's task id, or the internal request id for clients that know it
+    def lookup(self, key):
+        if key is None:
+            return None
+        request = self.task_ids.get(str(key))
+        if request is None and str(key).isdigit():
+            request = self.requests.get(int(key))
+        return request
+
+    def remove(self, request_id):
+        with self.lock:
+            request = self.requests.pop(request_id, None)
+            if request is not None:
+                if request.counted:
+                    self.path_counts[request.path] -= 1
+                if request.task_id is not None and self.task_ids.get(request.task_id) is request:
+                    del self.task_ids[request.task_id]
+            return request
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.requests.values())
+
+    def count(self, path = None):
+        if path is None:
+            return len(self.requests)
+        return self.path_counts.get(path, 0)
+
+    def path_counts_snapshot(self):
+        with self.lock:
+            return dict(self.path_counts)
+
+    def state_counts(self):
+        counts = {state: 0 for state in VALID_REQUEST_STATES}
+        for request in self.snapshot():
+            counts[request.state] += 1
+        return counts
+
+    def __len__(self):
+        return len(self.requests)
 
 
 ######################
@@ -121,20 +696,56 @@ class OpenOutpainterServingManager:
         self.enable_cross_origin_requests = None
         self.node_type = None
         self.node_id = None
-        self.requests = {}
-        self.request_id = 0 # next request id
+        self.requests = OpenOutpainterRequestRegistry()
+        self.coalescer = RequestCoalescer(self, POSTPATHS.PATH_TXT2IMG)
+        self.result_cache = ResultCache((POSTPATHS.PATH_TXT2IMG, POSTPATHS.PATH_IMG2IMG))
+        self.max_requests_per_endpoint = 0 # in-flight + queued requests allowed per POST path, 0 = no limit
+        self.request_durations = {} # path: smoothed request duration in seconds, for Retry-After
         self.http_running = False
         self.server_status = ""
         self.server = None
         self.thread = None
         self.comfy_progress_hook = None
-        self.progress = ProgressData()
+        self.progress = ProgressTracker()
         self.oop_styles = {}
         self.oop_checkpoints = []
         self.spammy_debug = False
-
-
-    def start_server(self, server_address, port, enable_cross_origin_requests, node_type, node_id, spammy_debug = False):
+        self.compress_responses = True # gzip/deflate the JSON-heavy GET replies if the client accepts it
+        self.server_mode = SERVERMODES.THREADING
+        self.submit_mode = SUBMITMODES.WEBUI
+        self.captured_prompt = None
+        self.captured_extra_pnginfo = None
+        self.request_timeout = 0 # seconds before an open request is failed, 0 = wait forever
+        self.reaper_thread = None
+        self.reaper_stop = threading.Event()
+
+        self.static_responses = {} # path: StaticResponse
+        self.update_static_responses()
+
+        # live values are read when /metrics is scraped
+        metrics.add_collector(self.collect_metrics)
+
+        # always mounted, only answer while running in prompt server mode
+        register_prompt_server_routes(self, self.is_prompt_server_mode)
+
+    def is_prompt_server_mode(self):
+        return self.http_running and self.server_mode == SERVERMODES.PROMPTSERVER
+
+    # only settings for the listener itself need a restart
+    # in prompt server mode there is no listener, so settings just get updated in start_server
+    def needs_restart(self, run_server, server_address, port, enable_cross_origin_requests, spammy_debug, server_mode):
+        if not run_server or self.server_mode != server_mode:
+            return True
+        if server_mode == SERVERMODES.PROMPTSERVER:
+            return False
+        return (
+            self.server_address != server_address or
+            self.port != port or
+            self.enable_cross_origin_requests != enable_cross_origin_requests or
+            self.spammy_debug != spammy_debug
+        )
+
+    def start_server(self, server_address, port, enable_cross_origin_requests, node_type, node_id, spammy_debug = False, server_mode = SERVERMODES.THREADING):
         # server config from workflow
         self.server_address = server_address
         self.port = port
@@ -142,20 +753,38 @@ class OpenOutpainterServingManager:
         self.node_type = node_type
         self.node_id = node_id
         self.spammy_debug = spammy_debug
+        self.server_mode = server_mode
+
+        self.start_reaper()
+
+        if not self.http_running and self.server_mode == SERVERMODES.PROMPTSERVER:
+            # nothing to start, routes are already mounted on PromptServer
+            self.http_running = True
+            self.server_status = "Server is running on ComfyUI's own address and port"
+            if not prompt_server_cors_enabled():
+                self.server_status += (", cross origin requests are handled by ComfyUI:"
+                    " start it with --enable-cors-header if OpenOutpaint is served from another origin")
+            print("OpenOutpaint API server running on ComfyUI's PromptServer")
 
         if not self.http_running:
             try:
-                self.thread = threading.Thread(target=self.http_handler, daemon=True)
+                if self.server_mode == SERVERMODES.ASYNCIO:
+                    self.server = OpenOutpainterAsyncServer(self, self.server_address, self.port)
+                    target = self.server.serve_forever
+                else:
+                    target = self.http_handler
+                self.thread = threading.Thread(target=target, daemon=True)
                 self.thread.start()
                 self.http_running = True
-                self.server_status = f"Server is running on {self.server_address}:{self.port}"
-                print(f"OpenOutpaint API server running on port {self.port}")
+                self.server_status = f"Server is running on {self.server_address}:{self.port} ({self.server_mode})"
+                print(f"OpenOutpaint API server running on port {self.port} ({self.server_mode})")
             except Exception as e:
                 self.http_running = False
                 self.server_status = "ERROR: Could not start OpenOutpaint API server: {}".format(e)
                 raise RuntimeError(self.server_status )
 
     def stop_server(self):
+        self.stop_reaper()
         self.cancel_open_requests()
         if self.http_running:
             self.http_running = False
@@ -164,114 +793,305 @@ class OpenOutpainterServingManager:
                 self.server.shutdown()
                 self.server.server_close()
                 self.thread.join()
+                self.server = None
             self.server_status = "Server not running"
             print(f"OpenOutpaint API server stopped on port {self.port}")
 
     def cancel_open_requests(self):
-        # iterate over a copy of keys instead as requests dict can change during this process
-        for request_id in self.requests.keys():
-            request = self.requests[request_id]
-            print(f"OpenOutpaint API server, canceling request_id: {request_id} request: {request}")
-            request.finalize({})
+        # iterate over a snapshot as requests can be removed by handlers during this process
+        for request in self.requests.snapshot():
+            print(f"OpenOutpaint API server, canceling request_id: {request.id} request: {request}")
+            # an error status, so the client and the result cache never take it for a finished render
+            request.finalize({"error": "Request was cancelled"}, status=503)
         PromptServer.instance.prompt_queue.wipe_queue()
         nodes.interrupt_processing()
 
+    ################################
+    #     Stale Request Reaper     #
+    ################################
+    # if a workflow errors the request would otherwise stay open forever,
+    # keeping its handler waiting and its request body in memory
+
+    def start_reaper(self):
+        if self.reaper_thread is not None and self.reaper_thread.is_alive():
+            return
+        self.reaper_stop.clear()
+        self.reaper_thread = threading.Thread(target=self.reaper_loop, daemon=True)
+        self.reaper_thread.start()
+
+    def stop_reaper(self):
+        self.reaper_stop.set()
+        if self.reaper_thread is not None:
+            self.reaper_thread.join()
+            self.reaper_thread = None
+
+    def reaper_loop(self):
+        while not self.reaper_stop.wait(self.reaper_interval()):
+            self.reap_stale_requests()
+
+    def reaper_interval(self):
+        if self.request_timeout <= 0:
+            return 5
+        return min(5, max(0.5, self.request_timeout / 4))
+
+    def reap_stale_requests(self):
+        now = time.time()
+        for request in self.requests.snapshot():
+            if request.is_stale(self.request_timeout, now):
+                print(f"OpenOutpaint API server, request_id: {request.id} timed out after {self.request_timeout}s")
+                request.release()
+                request.finalize({"error": f"Request timed out after {self.request_timeout}s, check the workflow for errors"}, status=504)
+
     def http_handler(self):
         class RequestHandler(BaseHTTPRequestHandler):
+            # persistent connections, OOP polls progress and options constantly
+            # every reply needs a Content-Length (or to close the connection) for this
+            protocol_version = "HTTP/1.1"
+
             def do_OPTIONS(self2):
                 if (self.enable_cross_origin_requests):
                     self2.send_response(200)
-                    self2.send_header('Access-Control-Allow-Origin', '*')
-                    self2.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-                    self2.send_header('Access-Control-Allow-Headers', '*')
-                    self2.end_headers()
+                    self2.cors_headers()
+                else:
+                    self2.send_response(405)
+                self2.send_header('Content-Length', '0')
+                self2.end_headers()
 
             def log_message(self, format, *args):
                 # Override method to suppress noisy logging
                 return
 
+            def send_response(self2, code, message = None):
+                self2.status_code = code # for RouteRegistry.record
+                super().send_response(code, message)
+
             def do_POST(self2):
+                self2.dispatch("POST", self2.handle_post)
+
+            def do_GET(self2):
+                self2.dispatch("GET", self2.handle_get)
+
+            def dispatch(self2, method, handler):
+                started = time.time()
+                self2.status_code = None
+                self2.bytes_sent = 0
+                route = routes.resolve(method, urlparse(self2.path).path)
+                try:
+                    handler(route)
+                finally:
+                    routes.record(method, route, self2.status_code, time.time() - started, self2.bytes_sent)
+
+            def handle_post(self2, route):
                 print(f"OpenOutpaint Received POST request: {self2.path}")
 
                 # unsupported command
-                if not self2.path in VALID_POST_PATHS:
-                    self2.send_response(404)
-                    self2.send_header('Content-type', 'application/json')
-                    self2.cors_headers()
-                    self2.end_headers()
-                    self2.wfile.write(json.dumps({"error": "Command not found"}).encode('utf-8'))
+                if route is None:
+                    self2.discard_body()
+                    self2.send_json(404, {"error": "Command not found"})
                     return
 
+                # reject before reading the body when already at the limit
+                try:
+                    self.check_admission(route.path)
+                except OpenOutpainterServerBusy as e:
+                    self2.discard_body()
+                    self2.send_busy(e)
+                    return
 
-                content_length = int(self2.headers['Content-Length'])
-                post_data = self2.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
+                # image fields are decoded from base64 while reading, the raw body is never held whole
+                try:
+                    content_length = int(self2.headers['Content-Length'])
+                    data = parse_request_body(self2.rfile.read, content_length)
+                except (TypeError, ValueError) as e:
+                    self2.close_connection = True # unknown how much of the body is left unread
+                    self2.send_json(400, {"error": f"Invalid request body: {e}"})
+                    return
 
                 # debug request
                 if self.spammy_debug:
                     print_list_or_dic(f"do_POST ({self2.path})", data)
 
-                # /sdapi/v1/options/ POST just needs to be told everything is ok
-                if self2.path == POSTPATHS.PATH_OPTIONS:
-                    self2.send_response(200)
-                    self2.send_header('Content-type', 'application/json')
-                    self2.cors_headers()
-                    self2.end_headers()
-                    self2.wfile.write(json.dumps({"status": "Whatever that was, it worked. Stop complaining. :O"}).encode('utf-8'))
+                # commands that don't need the workflow are answered right away
+                if route.kind == ROUTEKINDS.IMMEDIATE:
+                    self2.send_json(200, route.handler(self, data))
                     return
 
-                request = OpenOutpainterRequest(self.request_id, data, self2.path)
-                self.requests[self.request_id] = request
-                self.request_id += 1
-
-                # start workflow from webui so user can interact with it
-                self.queue_prompt(request)
+                try:
+                    request = self.create_request(route.path, data)
+                except OpenOutpainterServerBusy as e:
+                    self2.send_busy(e)
+                    return
+                except OpenOutpainterBadRequest as e:
+                    self2.send_json(400, {"error": f"Invalid request: {e}"})
+                    return
 
                 # for some reason this was needed to fix wait not working sometimes
                 request.output_ready.clear()
 
                 # waits here till workflow finished running
                 # if workflow errors, just manually run workflow again with same req id to complete API request
-                request.output_ready.wait()
+                # or wait for the reaper to time it out
+                if not request.finalized:
+                    request.output_ready.wait()
                 request.output_ready.clear()
 
-                # reset progress
-                self.progress.reset()
+                response = self.complete_request(request)
 
-                response = request.output
-
-                self2.send_response(200)
+                # base64 images are written in slices instead of dumping the whole response into one bytes
+                body = JsonResponseBody(response)
+                self2.send_response(request.status)
                 self2.send_header('Content-type', 'application/json')
+                self2.send_header('Content-Length', str(body.content_length))
                 self2.cors_headers()
                 self2.end_headers()
-                self2.wfile.write(json.dumps(response).encode('utf-8'))
-
-                # clean up
-                del self.requests[request.id]
+                try:
+                    write_json_body(self2.wfile.write, body)
+                    self2.bytes_sent += body.content_length
+                except (BrokenPipeError, ConnectionResetError):
+                    print("OpenOutpaint do_POST client disconnected before the response was sent")
+                    self2.close_connection = True
+                    return
 
                 print("OpenOutpaint do_POST finished")
 
-            def do_GET(self2):
-                response = self.process_get_request(self2.path)
+            def handle_get(self2, route):
+                # unsupported command
+                if route is None:
+                    self2.send_json(404, {"error": "Command not found"})
+                    return
+
+                if route.kind == ROUTEKINDS.STREAM:
+                    self2.stream_progress()
+                    return
+
+                if route.kind == ROUTEKINDS.STATIC:
+                    self2.send_static(self.static_responses[route.path], compress=route.compress)
+                    return
+
+                if route.kind == ROUTEKINDS.TEXT:
+                    self2.send_text(200, route.handler(self, urlparse(self2.path)))
+                    return
+
+                response = self.process_get_request(route, self2.path)
 
                 # debug response
                 if self.spammy_debug:
                     print_list_or_dic(f"do_GET ({self2.path})", response, True)
 
-                # unsupported command
                 if not response:
-                    self2.send_response(404)
-                    self2.send_header('Content-type', 'application/json')
+                    self2.send_json(404, {"error": "Command not found"})
+                    return
+
+                self2.send_json(200, response, compress=route.compress)
+
+            def stream_progress(self2):
+                stream = self.open_progress_stream(self2.path)
+                changed = threading.Event()
+                changed.set() # send the current state right away
+                token = self.progress.subscribe(lambda prompt_id: changed.set())
+                # no length known up front, the stream ends by closing the connection
+                self2.close_connection = True
+                try:
+                    self2.send_response(200)
+                    self2.send_header('Content-type', 'text/event-stream')
+                    self2.send_header('Cache-Control', 'no-cache')
+                    self2.send_header('Connection', 'close')
+                    self2.cors_headers()
+                    self2.end_headers()
+                    while not stream.done and self.http_running:
+                        if changed.wait(ProgressStream.KEEPALIVE_INTERVAL):
+                            changed.clear()
+                            event = stream.next_event()
+                            if event is not None:
+                                self2.bytes_sent += self2.wfile.write(ProgressStream.format_event(event)) or 0
+                                self2.wfile.flush()
+                        else:
+                            self2.bytes_sent += self2.wfile.write(ProgressStream.format_keepalive()) or 0
+                            self2.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # client went away
+                finally:
+                    self.progress.unsubscribe(token)
+
+            def send_busy(self2, e):
+                print(f"OpenOutpaint POST rejected: {e}")
+                self2.send_json(429, {"error": str(e)}, headers={'Retry-After': str(e.retry_after)})
+
+            def send_json(self2, status, data, headers = None, compress = False):
+                body = json.dumps(data).encode('utf-8')
+                encoding = None
+                if compress and self.compress_responses and len(body) >= COMPRESS_MIN_SIZE:
+                    encoding = negotiate_encoding(self2.headers.get('Accept-Encoding'))
+                    body = compress_body(body, encoding)
+                self2.send_response(status)
+                self2.send_header('Content-type', 'application/json')
+                self2.send_header('Content-Length', str(len(body)))
+                if compress:
+                    self2.send_header('Vary', 'Accept-Encoding')
+                if encoding is not None:
+                    self2.send_header('Content-Encoding', encoding)
+                if self2.close_connection:
+                    self2.send_header('Connection', 'close')
+                for name, value in (headers or {}).items():
+                    self2.send_header(name, value)
+                self2.cors_headers()
+                self2.end_headers()
+                self2.wfile.write(body)
+                self2.bytes_sent += len(body)
+
+            def send_static(self2, static, compress = False):
+                # negotiated first, the ETag differs per encoding
+                encoding = None
+                if compress and self.compress_responses and len(static.body) >= COMPRESS_MIN_SIZE:
+                    encoding = negotiate_encoding(self2.headers.get('Accept-Encoding'))
+                if static.not_modified(self2.headers.get('If-None-Match'), self2.headers.get('If-Modified-Since'), encoding):
+                    self2.send_response(304)
+                    if compress:
+                        self2.send_header('Vary', 'Accept-Encoding')
+                    for name, value in static.headers(encoding).items():
+                        self2.send_header(name, value)
                     self2.cors_headers()
                     self2.end_headers()
-                    self2.wfile.write(json.dumps({"error": "Command not found"}).encode('utf-8'))
                     return
-
+                body = static.get_body(encoding)
                 self2.send_response(200)
                 self2.send_header('Content-type', 'application/json')
+                self2.send_header('Content-Length', str(len(body)))
+                if compress:
+                    self2.send_header('Vary', 'Accept-Encoding')
+                if encoding is not None:
+                    self2.send_header('Content-Encoding', encoding)
+                for name, value in static.headers(encoding).items():
+                    self2.send_header(name, value)
                 self2.cors_headers()
                 self2.end_headers()
-                self2.wfile.write(json.dumps(response).encode('utf-8'))
+                self2.wfile.write(body)
+                self2.bytes_sent += len(body)
+
+            def send_text(self2, status, text, content_type = METRICS_CONTENT_TYPE):
+                body = text.encode('utf-8')
+                self2.send_response(status)
+                self2.send_header('Content-type', content_type)
+                self2.send_header('Content-Length', str(len(body)))
+                self2.cors_headers()
+                self2.end_headers()
+                self2.wfile.write(body)
+                self2.bytes_sent += len(body)
+
+            # unread request bodies would be parsed as the next request on a kept alive connection
+            def discard_body(self2):
+                try:
+                    content_length = int(self2.headers.get('Content-Length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0 or content_length > MAX_DISCARD_BODY_SIZE:
+                    self2.close_connection = True
+                    return
+                while content_length > 0:
+                    chunk = self2.rfile.read(min(content_length, 1 << 16))
+                    if not chunk:
+                        break
+                    content_length -= len(chunk)
 
             def cors_headers(self2):
                 if (self.enable_cross_origin_requests):
@@ -282,8 +1102,157 @@ class OpenOutpainterServingManager:
         self.server = ThreadingHTTPServer((self.server_address, self.port), RequestHandler)
         self.server.serve_forever()
 
-    # trigger workflow to run from webui :)
+    def server_busy(self, path):
+        # rough guess at when a slot frees up, at least a second
+        retry_after = max(1, math.ceil(self.request_durations.get(path, 1)))
+        return OpenOutpainterServerBusy(path, self.requests.count(path), retry_after)
+
+    # raises OpenOutpainterServerBusy if path is at its limit of open requests
+    def check_admission(self, path):
+        if 0 < self.max_requests_per_endpoint <= self.requests.count(path):
+            raise self.server_busy(path)
+
+    # register a new API request and start the workflow for it
+    # the caller then waits for request.output_ready (or a done callback) before calling complete_request
+    def create_request(self, path, data):
+        # a bad encode override would only fail in the output node, after the whole render
+        try:
+            parse_encode_overrides(data)
+        except ValueError as e:
+            raise OpenOutpainterBadRequest(str(e))
+
+        # identical deterministic request already rendered, answer with an already finalized request
+        cache_key = self.result_cache.make_key(path, data)
+        cached_output = self.result_cache.get(cache_key)
+        if cached_output is not None:
+            print(f"OpenOutpaint API server, {path} answered from result cache")
+            request = OpenOutpainterRequest(None, data, path)
+            request.cached = True
+            request.finalize(cached_output)
+            return request
+
+        # admission is checked again atomically with the insert
+        request = self.requests.create(data, path, self.max_requests_per_endpoint)
+        if request is None:
+            raise self.server_busy(path)
+
+        if cache_key is not None:
+            request.add_done_callback(lambda r: self.result_cache.put(cache_key, r.output) if r.status < 400 else None)
+
+        # compatible txt2img requests may be held briefly and run as one batch
+        if not self.coalescer.add(request):
+            # start workflow from webui so user can interact with it
+            self.queue_prompt(request)
+        return request
+
+    def complete_request(self, request):
+        # only this request's progress, other open requests keep theirs
+        self.progress.remove_request(request.id)
+        if request.task_id is not None:
+            self.progress.remove_request(request.task_id)
+        self.progress.notify()
+
+        response = request.output
+
+        # smoothed duration per endpoint, used for Retry-After
+        if not request.cached:
+            duration = time.time() - request.created_time
+            previous = self.request_durations.get(request.path)
+            self.request_durations[request.path] = duration if previous is None else previous * 0.8 + duration * 0.2
+
+        # clean up
+        self.requests.remove(request.id)
+        return response
+
+    def collect_metrics(self):
+        open_requests = {(path,): 0 for path in routes.paths("POST", ROUTEKINDS.WORKFLOW)}
+        open_requests.update(((path,), count) for path, count in self.requests.path_counts_snapshot().items())
+        open_requests_gauge.set_all(open_requests)
+        request_states_gauge.set_all(((state,), count) for state, count in self.requests.state_counts().items())
+        cache_gauge.set_all(
+            ((name, stat), value)
+            for name, stats in (("decode", decode_cache.stats()), ("result", self.result_cache.stats()))
+            for stat, value in stats.items() if isinstance(value, (int, float))
+        )
+
+    def get_status(self):
+        queue = {path: 0 for path in routes.paths("POST", ROUTEKINDS.WORKFLOW)}
+        queue.update(self.requests.path_counts_snapshot())
+        states = self.requests.state_counts()
+        return {
+            "running": self.http_running,
+            "server_mode": self.server_mode,
+            "submit_mode": self.submit_mode,
+            "max_requests_per_endpoint": self.max_requests_per_endpoint,
+            "request_timeout": self.request_timeout,
+            "queue_depth": sum(states.values()),
+            "queue": queue,
+            "states": states,
+            "average_duration": self.request_durations,
+            "decode_cache": decode_cache.stats(),
+            "coalesce_window": self.coalescer.window,
+            "result_cache": self.result_cache.stats(),
+            "routes": routes.stats(),
+        }
+
+    # keep a copy of the serving workflow's prompt graph for headless submission
+    def capture_prompt(self, prompt, extra_pnginfo = None):
+        if prompt is None:
+            return
+        self.captured_prompt = copy.deepcopy(prompt)
+        self.captured_extra_pnginfo = copy.deepcopy(extra_pnginfo)
+
     def queue_prompt(self, request):
+        if self.submit_mode == SUBMITMODES.HEADLESS:
+            if self.captured_prompt is not None:
+                self.queue_prompt_headless(request)
+                return
+            print("OpenOutpaint API server: no captured workflow yet for headless mode, falling back to webui")
+        self.queue_prompt_webui(request)
+
+    # queue a copy of the captured workflow with the request_id patched in, skipping the browser round-trip
+    def queue_prompt_headless(self, request):
+        prompt = copy.deepcopy(self.captured_prompt)
+        prompt[str(self.node_id)]["inputs"]["request_id"] = request.id
+        request.prompt_id = str(uuid.uuid4())
+        # prompt queue and validation live on ComfyUI's event loop, don't wait on it here
+        asyncio.run_coroutine_threadsafe(self.submit_prompt(request, prompt), PromptServer.instance.loop)
+
+    async def submit_prompt(self, request, prompt):
+        server = PromptServer.instance
+        self.bind_progress(request, request.prompt_id)
+        for member in request.members:
+            self.bind_progress(member, request.prompt_id)
+        try:
+            valid = await execution.validate_prompt(request.prompt_id, prompt, None)
+            if not valid[0]:
+                print(f"OpenOutpaint API server, invalid headless prompt for request_id: {request.id} error: {valid[1]} {valid[3]}")
+                self.fail_request(request, {"error": "Workflow failed validation", "details": valid[1]}, 500)
+                return
+
+            extra_data = {}
+            if self.captured_extra_pnginfo is not None:
+                extra_data["extra_pnginfo"] = self.captured_extra_pnginfo
+
+            number = server.number
+            server.number += 1
+            item = (number, request.prompt_id, prompt, extra_data, valid[2])
+            if hasattr(execution, "SENSITIVE_EXTRA_DATA_KEYS"):
+                # newer ComfyUI queues sensitive extra data separately
+                item = item + ({},)
+            server.prompt_queue.put(item)
+        except Exception as e:
+            print(f"OpenOutpaint API server, could not queue headless prompt for request_id: {request.id} error: {e}")
+            self.fail_request(request, {"error": f"Could not queue workflow: {e}"}, 500)
+
+    # the workflow will never answer this request, merged members included
+    def fail_request(self, request, output, status):
+        for member in request.members:
+            member.finalize(output, status=status)
+        request.finalize(output, status=status)
+
+    # trigger workflow to run from webui :)
+    def queue_prompt_webui(self, request):
         PromptServer.instance.send_sync("wo_QueuePrompt", {
             "node_type": self.node_type,
             "node_id": self.node_id,
@@ -293,167 +1262,253 @@ class OpenOutpainterServingManager:
 
     def get_data(self, request_id):
         print(f"get_data: start r:{request_id}")
-        return self.requests.get(request_id, None)
+        request = self.requests.get(request_id)
+        if request is not None:
+            request.mark_running()
+            # this is called from the serving node, so the executing prompt is the request's prompt
+            progress_state = get_progress_state()
+            prompt_id = request.prompt_id or getattr(progress_state, "prompt_id", None)
+            self.bind_progress(request, prompt_id)
+            # merged requests follow the progress of the request they were merged into
+            for member in request.members:
+                member.mark_running()
+                self.bind_progress(member, prompt_id)
+        return request
+
+    def bind_progress(self, request, prompt_id):
+        self.progress.bind_request(request.id, prompt_id)
+        if request.task_id is not None:
+            self.progress.bind_request(request.task_id, prompt_id)
+
+    # id_task (the force_task_id the client sent with its POST) or request_id from a progress query
+    @staticmethod
+    def get_progress_key(query):
+        return query.get('id_task', query.get('request_id', [None]))[0]
+
+    # query: id_task (or request_id) to follow one request, skip_current_image to leave out previews
+    def open_progress_stream(self, url):
+        query = parse_qs(urlparse(url).query)
+        skip_current_image = query.get('skip_current_image', ['false'])[0].lower() != 'false'
+        return ProgressStream(self, self.get_progress_key(query), skip_current_image)
 
     def add_progress_handler(self):
         add_progress_handler(OpenOutpainterProgressHandler(self.progress))
 
-    def process_get_request(self, url):
-        url = urlparse(url)
-        path = url.path
-
-        print(f"process_get_request: {path}")
-
-        match path:
-            case '/startup-events':
-                # output is not used for anything other than printing out server
-                # startup errors when there is a connection error
-                return {"status": "ok"}
-
-            case '/sdapi/v1/interrupt':
-                # cancel running gen
-                # not yet implemented
-                # ComfyUI doesn't respond super well to stopping anyway
-                # but just forcing anything in the queue to finish clears stuck jobs due to workflow error
-                self.cancel_open_requests()
-                return {"status": "(LIE) Yup, we totally canceled that job."}
-
-            case '/sdapi/v1/progress':
-                # get progress of current running gen
-                # request: skip_current_image: false = return latent preview
-                # response: see notes below
-
-                query = parse_qs(url.query)
-                skip_current_image = query.get('skip_current_image', 'false')
-                if isinstance(skip_current_image, list):
-                    skip_current_image = skip_current_image[0]
-                skip_current_image = str(skip_current_image).lower() != 'false'
-
-                progress, current_image, eta = self.progress.get_progress(skip_current_image)
-
-                return {
-                    "progress": progress, # float
-                    "eta_relative": eta, # estimated time remaining in seconds
-                    "current_image": current_image, # latent preview as a base64 encoded png
-                }
-
-            case '/sdapi/v1/options':
-                # Gets the current settings and config of the backend to fill in ui controls
-                # and check for supported configuration
-                # I don't use those controls in OOP, and not implemented
-                # so mostly placeholder info can be returned that makes OOP not complain
-                # data that is used:
-                # `use_scale_latent_for_hires_fix` is False or undefined
-                # `sd_model_checkpoint` for currently "loaded"/selected checkpoint
-                # `sd_checkpoint_hash` only checked if the above is undefined
-                # `img2img_color_correction` is not True
-                # `inpainting_mask_weight` is set to 1.0
-                return {
-                    "status": "ok",
-                    "sd_model_checkpoint": "", # TODO: make openoutpaint not change settings based on what the api returns
-                    "sd_checkpoint_hash": "",
-                    "img2img_color_correction": False,
-                    "inpainting_mask_weight": 1.0,
-                }
-
-            case '/sdapi/v1/upscalers':
-                # return list of upscalers, can just be dummy option and config this within workflow
-                # only "name" is required
-                return [
-                    "[WIP] Use Workflow",
-                ]
-
-            case '/sdapi/v1/sd-models':
-                # return list of checkpoints
-                # Previously this returned an A1111 styled list of models,
-                # but that isn't required anymore, just need a simple list now
-                return self.oop_checkpoints
-
-            case '/sdapi/v1/loras':
-                # return list of loras, can be empty and config this within workflow
-                # only "name" is used
-                return [
-                    {"name": "Configure LoRAs in workflow"},
-                ]
-
-            case '/sdapi/v1/samplers':
-                # return list of samplers, can just be dummy option and config this within workflow
-                # only "name" is used
-                return [
-                    {"name": "Configure sampler in workflow"},
-                ]
-
-            case '/sdapi/v1/schedulers':
-                # return list of schedulers, can just be dummy option and config this within workflow
-                # only "name" and "label" are used
-                return [
-                    {"name": "automatic", "label": "Automatic"},
-                ]
-
-            case '/sdapi/v1/prompt-styles':
-                # return list of A1111 prompt-styles
-                # These are passed by as a multiple selected list by name for txt2img and img2img in "styles"
-                # only "name" is used, but the prompts are displayed in the tooltip for each
-                # {"name": "", "prompt": "", "negative_prompt":""},
-                return list(self.oop_styles.values())
-
-            ########################
-            # Extensions Functions #
-            ########################
-
-            case '/sdapi/v1/scripts':
-                # list of extensions
-                # OOP only looks for controlnet and dynamic prompts to enable those features in its UI
-                # extension support in OOP is not very complete
-                # cn can be omitted as can be done better in the workflow manually
-                # return almost the minimum to make OOP not complain
-                return {
-                    "txt2img": [
-                        "extra options",
-                        "openoutpaint",
-                        "refiner",
-                        "sampler",
-                        "seed"
-                    ],
-                    "img2img": [
-                        "extra options",
-                        "openoutpaint",
-                        "refiner",
-                        "sampler",
-                        "seed"
-                    ]
-                }
-
-            case '/controlnet/version':
-                # a1111 cn extension version, needs to be > 0 to enable ui
-                # sending 0 to disable, use workflow instead
-                return {"version": 0}
-
-            case '/controlnet/settings':
-                # number of ref layers needs to be not < 2 or triggers warning
-                return {"control_net_unit_count": 2}
-
-            case '/controlnet/model_list':
-                # list of controlnet models
-                # use workflow instead, send empty
-                return {"model_list": []}
-
-            case '/controlnet/module_list':
-                # list of controlnet modules
-                # not sure if can just be empty it not used
-                return {
-                    "module_list": ["none", "inpaint"],
-                    "module_detail": {
-                        "none": {
-                            "model_free": False,
-                            "sliders": []
-                        },
-                        "inpaint": {
-                            "model_free": False,
-                            "sliders": []
-                        }
-                    }
-                }
-
-        return None
+    # re-serialize the static GET replies, called by the serving node after it sets styles and checkpoints
+    # the dict is swapped in whole, handlers never see a half built one
+    def update_static_responses(self):
+        previous = self.static_responses
+        self.static_responses = {
+            route.path: StaticResponse(route.handler(self, urlparse(route.path)), previous.get(route.path))
+            for route in routes.routes.values() if route.kind == ROUTEKINDS.STATIC
+        }
 
+    def process_get_request(self, route, url):
+        url = urlparse(url)
+        print(f"process_get_request: {url.path}")
+        return route.handler(self, url)
+
+
+##################
+#   GET Routes   #
+##################
+# handler(manager, url), returning None answers with 404
+
+@routes.get(PATH_PROGRESS_STREAM, ROUTEKINDS.STREAM)
+def get_progress_stream(manager, url):
+    # server-sent events, written by the front ends from manager.open_progress_stream
+    return None
+
+@routes.get('/startup-events', ROUTEKINDS.STATIC)
+def get_startup_events(manager, url):
+    # output is not used for anything other than printing out server
+    # startup errors when there is a connection error
+    return {"status": "ok"}
+
+@routes.get('/sdapi/v1/interrupt')
+def get_interrupt(manager, url):
+    # cancel running gen
+    # not yet implemented
+    # ComfyUI doesn't respond super well to stopping anyway
+    # but just forcing anything in the queue to finish clears stuck jobs due to workflow error
+    manager.cancel_open_requests()
+    return {"status": "(LIE) Yup, we totally canceled that job."}
+
+@routes.get('/sdapi/v1/progress', blocking=True)
+def get_progress(manager, url):
+    # get progress of current running gen
+    # request: skip_current_image: false = return latent preview
+    # request: id_task: optional, progress of the request POSTed with that force_task_id instead of the current one
+    #          (request_id is accepted too), unknown or not yet started ids report 0
+    # request: include_nodes: true = also return per node progress, not part of the A1111 api
+    # response: see notes below
+
+    query = parse_qs(url.query)
+    skip_current_image = query.get('skip_current_image', 'false')
+    if isinstance(skip_current_image, list):
+        skip_current_image = skip_current_image[0]
+    skip_current_image = str(skip_current_image).lower() != 'false'
+
+    request_id = manager.get_progress_key(query)
+
+    progress, current_image, eta = manager.progress.get_progress(skip_current_image, request_id)
+
+    response = {
+        "progress": progress, # float
+        "eta_relative": eta, # estimated time remaining in seconds
+        "current_image": current_image, # latent preview as a base64 encoded png
+    }
+    if query.get('include_nodes', ['false'])[0].lower() == 'true':
+        response["nodes"] = manager.progress.get_node_progress(request_id) # node_id: {"value", "max"}
+    return response
+
+@routes.get('/sdapi/v1/options', ROUTEKINDS.STATIC, compress=True)
+def get_options(manager, url):
+    # Gets the current settings and config of the backend to fill in ui controls
+    # and check for supported configuration
+    # I don't use those controls in OOP, and not implemented
+    # so mostly placeholder info can be returned that makes OOP not complain
+    # data that is used:
+    # `use_scale_latent_for_hires_fix` is False or undefined
+    # `sd_model_checkpoint` for currently "loaded"/selected checkpoint
+    # `sd_checkpoint_hash` only checked if the above is undefined
+    # `img2img_color_correction` is not True
+    # `inpainting_mask_weight` is set to 1.0
+    return {
+        "status": "ok",
+        "sd_model_checkpoint": "", # TODO: make openoutpaint not change settings based on what the api returns
+        "sd_checkpoint_hash": "",
+        "img2img_color_correction": False,
+        "inpainting_mask_weight": 1.0,
+    }
+
+@routes.get('/sdapi/v1/upscalers', ROUTEKINDS.STATIC, compress=True)
+def get_upscalers(manager, url):
+    # return list of upscalers, can just be dummy option and config this within workflow
+    # only "name" is required
+    return [
+        "[WIP] Use Workflow",
+    ]
+
+@routes.get('/sdapi/v1/sd-models', ROUTEKINDS.STATIC, compress=True)
+def get_sd_models(manager, url):
+    # return list of checkpoints
+    # Previously this returned an A1111 styled list of models,
+    # but that isn't required anymore, just need a simple list now
+    return manager.oop_checkpoints
+
+@routes.get('/sdapi/v1/loras', ROUTEKINDS.STATIC, compress=True)
+def get_loras(manager, url):
+    # return list of loras, can be empty and config this within workflow
+    # only "name" is used
+    return [
+        {"name": "Configure LoRAs in workflow"},
+    ]
+
+@routes.get('/sdapi/v1/samplers', ROUTEKINDS.STATIC, compress=True)
+def get_samplers(manager, url):
+    # return list of samplers, can just be dummy option and config this within workflow
+    # only "name" is used
+    return [
+        {"name": "Configure sampler in workflow"},
+    ]
+
+@routes.get('/sdapi/v1/schedulers', ROUTEKINDS.STATIC, compress=True)
+def get_schedulers(manager, url):
+    # return list of schedulers, can just be dummy option and config this within workflow
+    # only "name" and "label" are used
+    return [
+        {"name": "automatic", "label": "Automatic"},
+    ]
+
+@routes.get('/sdapi/v1/prompt-styles', ROUTEKINDS.STATIC, compress=True)
+def get_prompt_styles(manager, url):
+    # return list of A1111 prompt-styles
+    # These are passed by as a multiple selected list by name for txt2img and img2img in "styles"
+    # only "name" is used, but the prompts are displayed in the tooltip for each
+    # {"name": "", "prompt": "", "negative_prompt":""},
+    return list(manager.oop_styles.values())
+
+@routes.get('/openoutpaint/v1/status')
+def get_server_status(manager, url):
+    # not part of the A1111 api, queue depth and limits of this server
+    return manager.get_status()
+
+########################
+# Extensions Functions #
+########################
+
+@routes.get('/sdapi/v1/scripts', ROUTEKINDS.STATIC, compress=True)
+def get_scripts(manager, url):
+    # list of extensions
+    # OOP only looks for controlnet and dynamic prompts to enable those features in its UI
+    # extension support in OOP is not very complete
+    # cn can be omitted as can be done better in the workflow manually
+    # return almost the minimum to make OOP not complain
+    return {
+        "txt2img": [
+            "extra options",
+            "openoutpaint",
+            "refiner",
+            "sampler",
+            "seed"
+        ],
+        "img2img": [
+            "extra options",
+            "openoutpaint",
+            "refiner",
+            "sampler",
+            "seed"
+        ]
+    }
+
+@routes.get('/controlnet/version', ROUTEKINDS.STATIC)
+def get_controlnet_version(manager, url):
+    # a1111 cn extension version, needs to be > 0 to enable ui
+    # sending 0 to disable, use workflow instead
+    return {"version": 0}
+
+@routes.get('/controlnet/settings', ROUTEKINDS.STATIC)
+def get_controlnet_settings(manager, url):
+    # number of ref layers needs to be not < 2 or triggers warning
+    return {"control_net_unit_count": 2}
+
+@routes.get('/controlnet/model_list', ROUTEKINDS.STATIC, compress=True)
+def get_controlnet_model_list(manager, url):
+    # list of controlnet models
+    # use workflow instead, send empty
+    return {"model_list": []}
+
+@routes.get('/controlnet/module_list', ROUTEKINDS.STATIC, compress=True)
+def get_controlnet_module_list(manager, url):
+    # list of controlnet modules
+    # not sure if can just be empty it not used
+    return {
+        "module_list": ["none", "inpaint"],
+        "module_detail": {
+            "none": {
+                "model_free": False,
+                "sliders": []
+            },
+            "inpaint": {
+                "model_free": False,
+                "sliders": []
+            }
+        }
+    }
+
+
+@routes.get('/metrics', ROUTEKINDS.TEXT)
+def get_metrics(manager, url):
+    # Prometheus text format, not part of the A1111 api
+    return metrics.render()
+
+###################
+#   POST Routes   #
+###################
+# handler(manager, data), POSTs answered by the workflow are registered by their node modules
+
+@routes.post(POSTPATHS.PATH_OPTIONS)
+def post_options(manager, data):
+    # /sdapi/v1/options/ POST just needs to be told everything is ok
+    return {"status": "Whatever that was, it worked. Stop complaining. :O"}
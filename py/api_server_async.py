@@ -0,0 +1,326 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlparse
+from aiohttp import web
+from server import PromptServer
+from .utils import print_list_or_dic
+from .request_parser import parse_request_body_async
+from .response_writer import JsonResponseBody, negotiate_encoding, COMPRESS_MIN_SIZE
+from . import api_server
+
+
+#############################
+#     Asyncio API Server    #
+#############################
+# aiohttp front end for OpenOutpainterServingManager.
+# Uses the same route registry as the threaded server (api_server.routes).
+# Open generation requests wait on futures resolved by OpenOutpainterRequest.finalize
+# instead of parking an OS thread each, so lots of progress polling while long jobs
+# run stays cheap.
+# The handlers can either run on their own event loop and port (OpenOutpainterAsyncServer)
+# or be mounted on ComfyUI's own PromptServer (register_prompt_server_routes).
+
+class OpenOutpainterAiohttpHandlers:
+    def __init__(self, manager):
+        self.manager = manager
+
+    ##################
+    #     Routing    #
+    ##################
+
+    async def handle(self, request):
+        if request.method == "OPTIONS":
+            return self.handle_options(request)
+        started = time.time()
+        route = api_server.routes.resolve(request.method, request.path)
+        response = None
+        try:
+            response = await self.dispatch(request, route)
+            return response
+        finally:
+            api_server.routes.record(
+                request.method, route,
+                response.status if response is not None else None,
+                time.time() - started,
+                self.response_size(response),
+            )
+
+    async def dispatch(self, request, route):
+        if request.method == "POST":
+            return await self.handle_post(request, route)
+        if request.method == "GET":
+            if route is not None and route.kind == api_server.ROUTEKINDS.STREAM:
+                return await self.handle_progress_stream(request)
+            return await self.handle_get(request, route)
+        return self.json_response({"error": "Method not allowed"}, status=405)
+
+    def handle_options(self, request):
+        if self.manager.enable_cross_origin_requests:
+            return web.Response(status=200, headers=self.cors_headers())
+        return web.Response(status=405)
+
+    async def handle_get(self, request, route):
+        # unsupported command
+        if route is None:
+            return self.json_response({"error": "Command not found"}, status=404)
+
+        if route.kind == api_server.ROUTEKINDS.STATIC:
+            return self.static_response(request, route, self.manager.static_responses[route.path])
+
+        if route.kind == api_server.ROUTEKINDS.TEXT:
+            return web.Response(
+                body=route.handler(self.manager, urlparse(request.path_qs)).encode('utf-8'),
+                headers={'Content-Type': api_server.METRICS_CONTENT_TYPE, **self.cors_headers()},
+            )
+
+        if route.blocking:
+            # eg. progress encodes a new latent preview, keep that off the event loop (ComfyUI's own in comfyui mode)
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(None, self.manager.process_get_request, route, request.path_qs)
+        else:
+            response = self.manager.process_get_request(route, request.path_qs)
+
+        # debug response
+        if self.manager.spammy_debug:
+            print_list_or_dic(f"handle_get ({request.path})", response, True)
+
+        if not response:
+            return self.json_response({"error": "Command not found"}, status=404)
+
+        response = self.json_response(response)
+        if self.manager.compress_responses and route.compress:
+            # aiohttp negotiates Accept-Encoding itself, keep-alive and Content-Length are its default
+            response.enable_compression()
+        return response
+
+    # pre-serialized replies, revalidated with ETag / Last-Modified
+    def static_response(self, request, route, static):
+        # negotiated first, the ETag differs per encoding
+        encoding = None
+        if route.compress and self.manager.compress_responses and len(static.body) >= COMPRESS_MIN_SIZE:
+            encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        headers = {**self.cors_headers(), **static.headers(encoding)}
+        if route.compress:
+            headers['Vary'] = 'Accept-Encoding'
+        if static.not_modified(request.headers.get('If-None-Match'), request.headers.get('If-Modified-Since'), encoding):
+            return web.Response(status=304, headers=headers)
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        return web.Response(body=static.get_body(encoding), content_type='application/json', headers=headers)
+
+    async def handle_progress_stream(self, request):
+        stream = self.manager.open_progress_stream(request.path_qs)
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        changed.set() # send the current state right away
+        # notifications come from the ComfyUI execution thread
+        token = self.manager.progress.subscribe(lambda prompt_id: loop.call_soon_threadsafe(changed.set))
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            **self.cors_headers(),
+        })
+        try:
+            await response.prepare(request)
+            while not stream.done and self.manager.http_running:
+                try:
+                    await asyncio.wait_for(changed.wait(), api_server.ProgressStream.KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    await response.write(api_server.ProgressStream.format_keepalive())
+                    continue
+                changed.clear()
+                # previews may need encoding, keep that off the event loop
+                event = await loop.run_in_executor(None, stream.next_event)
+                if event is not None:
+                    await response.write(api_server.ProgressStream.format_event(event))
+        except ConnectionResetError:
+            pass # client went away
+        finally:
+            self.manager.progress.unsubscribe(token)
+        return response
+
+    async def handle_post(self, request, route):
+        print(f"OpenOutpaint Received POST request: {request.path}")
+
+        # unsupported command
+        if route is None:
+            return self.json_response({"error": "Command not found"}, status=404)
+        path = route.path
+
+        # reject before reading the body when already at the limit
+        try:
+            self.manager.check_admission(path)
+        except api_server.OpenOutpainterServerBusy as e:
+            return self.busy_response(e)
+
+        # image fields are decoded from base64 while reading, the raw body is never held whole
+        try:
+            data = await parse_request_body_async(request.content)
+        except ValueError as e:
+            return self.json_response({"error": f"Invalid request body: {e}"}, status=400)
+
+        # debug request
+        if self.manager.spammy_debug:
+            print_list_or_dic(f"handle_post ({path})", data)
+
+        # commands that don't need the workflow are answered right away
+        if route.kind == api_server.ROUTEKINDS.IMMEDIATE:
+            return self.json_response(route.handler(self.manager, data))
+
+        try:
+            oop_request = self.manager.create_request(path, data)
+        except api_server.OpenOutpainterServerBusy as e:
+            return self.busy_response(e)
+        except api_server.OpenOutpainterBadRequest as e:
+            return self.json_response({"error": f"Invalid request: {e}"}, status=400)
+
+        # waits here till workflow finished running without blocking the loop
+        await self.wait_for_output(oop_request)
+
+        response = self.manager.complete_request(oop_request)
+
+        print("OpenOutpaint handle_post finished")
+        return await self.stream_json_response(request, response, status=oop_request.status)
+
+    async def wait_for_output(self, oop_request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def set_result(oop_request):
+            if not future.done():
+                future.set_result(oop_request.output)
+
+        # finalize is called from the ComfyUI execution thread
+        oop_request.add_done_callback(lambda r: loop.call_soon_threadsafe(set_result, r))
+        return await future
+
+    ###################
+    #     Helpers     #
+    ###################
+
+    def cors_headers(self):
+        if not self.manager.enable_cross_origin_requests:
+            return {}
+        return {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+            'Access-Control-Allow-Headers': '*',
+        }
+
+    def json_response(self, data, status=200, headers=None):
+        return web.Response(
+            body=json.dumps(data).encode('utf-8'),
+            status=status,
+            content_type='application/json',
+            headers={**self.cors_headers(), **(headers or {})},
+        )
+
+    # large responses, base64 images are written in slices with a precomputed Content-Length
+    async def stream_json_response(self, request, data, status=200):
+        body = JsonResponseBody(data)
+        response = web.StreamResponse(status=status, headers=self.cors_headers())
+        response.content_type = 'application/json'
+        response.content_length = body.content_length
+        try:
+            await response.prepare(request)
+            for chunk in body:
+                await response.write(chunk)
+            await response.write_eof()
+        except ConnectionResetError:
+            print("OpenOutpaint handle_post client disconnected before the response was sent")
+        return response
+
+    # web.Response bodies are only written after the handler returns, streamed ones already are
+    @staticmethod
+    def response_size(response):
+        if response is None:
+            return 0
+        if isinstance(response, web.Response):
+            body = response.body
+            return len(body) if isinstance(body, (bytes, bytearray)) else 0
+        return response.body_length
+
+    def busy_response(self, e):
+        print(f"OpenOutpaint POST rejected: {e}")
+        return self.json_response({"error": str(e)}, status=429, headers={'Retry-After': str(e.retry_after)})
+
+
+class OpenOutpainterAsyncServer:
+    def __init__(self, manager, server_address, port):
+        self.handlers = OpenOutpainterAiohttpHandlers(manager)
+        self.server_address = server_address
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+
+    # mirrors the parts of ThreadingHTTPServer's api used by the manager
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.start())
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.cleanup())
+            self.loop.close()
+
+    def shutdown(self):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def server_close(self):
+        # cleanup happens on the loop thread once serve_forever returns
+        pass
+
+    async def start(self):
+        app = web.Application(client_max_size=0) # no limit, img2img bodies can be huge
+        app.router.add_route("*", "/{tail:.*}", self.handlers.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.server_address, self.port)
+        await site.start()
+
+    async def cleanup(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+#####################################
+#     ComfyUI PromptServer Routes    #
+#####################################
+# Mounts the A1111 routes on ComfyUI's own aiohttp app, so no extra thread, socket or
+# restart cycle is needed. PromptServer only accepts new routes before it starts,
+# so they are always registered at import and just 404 unless the manager is running
+# in prompt server mode.
+# ComfyUI's own middleware runs in front of these routes: unless ComfyUI is started with
+# --enable-cors-header it answers OPTIONS itself and rejects requests whose Origin doesn't
+# match a loopback Host (eg. OOP served from another localhost port) with 403,
+# so enable_cross_origin_requests has no effect in this mode.
+
+PROMPT_SERVER_ROUTES = [
+    '/startup-events',
+    '/sdapi/v1/{tail:.*}',
+    '/controlnet/{tail:.*}',
+    '/openoutpaint/v1/{tail:.*}',
+    '/metrics',
+]
+
+def prompt_server_cors_enabled():
+    try:
+        from comfy.cli_args import args
+        return bool(args.enable_cors_header)
+    except (ImportError, AttributeError):
+        return False
+
+def register_prompt_server_routes(manager, is_enabled):
+    handlers = OpenOutpainterAiohttpHandlers(manager)
+
+    async def handle(request):
+        if not is_enabled():
+            return web.json_response({"error": "OpenOutpaint API is not running on this server"}, status=404)
+        return await handlers.handle(request)
+
+    for path in PROMPT_SERVER_ROUTES:
+        PromptServer.instance.routes.route("*", path)(handle)
@@ -1,7 +1,7 @@
 import json
 from comfy_execution.graph import ExecutionBlocker
-from .utils import get_category, base64_to_image, base64_to_mask, images_to_base64
-from .api_server import POSTPATHS
+from .utils import get_category, images_to_base64, batch_mask
+from .api_server import POSTPATHS, routes
 
 
 ########################
@@ -22,7 +22,7 @@ from .api_server import POSTPATHS
 #     "height": 512,
 #     "n_iter": 3,
 #     "mask": "data:image/png;base64,iVBORw0KGgoAAPQAAAABJRU5ErkJggg==",
-#     "init_images": ["data:image/png;base64,iVBORwo9jTl4TD/Er4/f5by6KwHISuQmCC"],
+#     "init_images": ["data:image/png;base64,iVBORwo9jTl4TD/Er4/f5by6KwHISuQmCC"], # more than one are batched, resized to the first
 #     "image_cfg_scale": 8,
 # }
 
@@ -88,9 +88,12 @@ class OpenOutpainterServingInputIMG2IMG:
         if not oop_request.is_command(self.command_name):
             return (ExecutionBlocker(None),) * len(self.OUTPUTS)
         request_data = oop_request.request_data
+        # all init images in one batch, with the mask broadcast to match
+        init_images = oop_request.get_image_batch("init_images")
+        mask = batch_mask(oop_request.get_mask("mask"), init_images.shape[0], init_images.shape[1:3])
         return (
-            base64_to_image(request_data["init_images"][0]),
-            base64_to_mask(request_data["mask"]),
+            init_images,
+            mask,
             request_data["prompt"],
             request_data["negative_prompt"],
             int(request_data["width"]),
@@ -143,7 +146,11 @@ class OpenOutpainterServingOutputIMG2IMG:
         print(f"{self.NAME} out '{self.command_name}' images: {bool(images is not None)}")
         if images is not None and SEEDS is not None and oop_request[0].is_command(self.command_name):
             response = {
-                "images": images_to_base64(images),
+                "images": images_to_base64(
+                    images,
+                    oop_request[0].extra_data.get("encode_workers"),
+                    oop_request[0].get_encode_settings(),
+                ),
                 "info": json.dumps({"all_seeds": SEEDS}, default=lambda o: None)
             }
             oop_request[0].finalize(response)
@@ -155,6 +162,9 @@ class OpenOutpainterServingOutputIMG2IMG:
 #########################
 # I'm lazy and don't want to define a bunch of duplicate data in separate file to register nodes.
 
+# the API route the nodes above answer, requests to it are queued for the workflow
+routes.add_workflow(POSTPATHS.PATH_IMG2IMG)
+
 def get_nodes():
     return [
         OpenOutpainterServingInputIMG2IMG,
@@ -1,6 +1,6 @@
 from comfy_execution.graph import ExecutionBlocker
-from .utils import get_category, base64_to_image
-from .api_server import POSTPATHS
+from .utils import get_category
+from .api_server import POSTPATHS, routes
 
 
 ############################
@@ -45,7 +45,7 @@ class OpenOutpainterServingInputInterrogate:
         # lazy eval does not work for some reason
         if not oop_request.is_command(self.command_name):
             return (ExecutionBlocker(None),)
-        return (base64_to_image(oop_request.request_data["image"]),)
+        return (oop_request.get_image("image"),)
 
 
 class OpenOutpainterServingOutputInterrogate:
@@ -89,6 +89,9 @@ class OpenOutpainterServingOutputInterrogate:
 #########################
 # I'm lazy and don't want to define a bunch of duplicate data in separate file to register nodes.
 
+# the API route the nodes above answer, requests to it are queued for the workflow
+routes.add_workflow(POSTPATHS.PATH_INTERROGATE)
+
 def get_nodes():
     return [
         OpenOutpainterServingInputInterrogate,
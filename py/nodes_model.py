@@ -1,4 +1,3 @@
-import re
 from comfy_execution.graph import ExecutionBlocker
 from .utils import get_category
 
@@ -66,13 +65,8 @@ class OpenOutpainterServingModelSwitch:
 
     def out(self, oop_request, checkpoint_name, use_regex, output_checkpoint_name_on_no_match):
         selected_checkpoint = oop_request.request_data.get('checkpoint', "")
-        test = bool(checkpoint_name == selected_checkpoint)
-        if use_regex:
-            try:
-                match = re.search(checkpoint_name, selected_checkpoint)
-                test = match is not None
-            except re.error:
-                test = False
+        # memoized per request, patterns are compiled once (invalid ones never match)
+        test = oop_request.checkpoint_matches(checkpoint_name, use_regex)
         if test:
             return (
                 oop_request, # oop_request_if_true
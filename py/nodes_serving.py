@@ -1,6 +1,6 @@
 from comfy_execution.graph import ExecutionBlocker
-from .utils import get_category
-from .api_server import OpenOutpainterServingManager
+from .utils import get_category, PREVIEW_FORMATS, DEFAULT_ENCODE_WORKERS, OUTPUT_CODECS, EncodeSettings, decode_cache
+from .api_server import OpenOutpainterServingManager, SERVERMODES, VALID_SERVER_MODES, SUBMITMODES, VALID_SUBMIT_MODES
 
 
 # global server manager
@@ -32,12 +32,30 @@ class OpenOutpainterServing:
                 "enable_cross_origin_requests": ("BOOLEAN", {"default": False}),
                 "request_id": ("INT", {"default": -1, "min": -1, "max": 1125899906842624}),
                 "spammy_debug": ("BOOLEAN", {"default": False}),
+                "server_mode": (VALID_SERVER_MODES, {"default": SERVERMODES.THREADING, "tooltip": "threading: one thread per open request. asyncio: single event loop, open requests wait on futures, cheaper with lots of progress polling. comfyui: mount the API on ComfyUI's own address and port, no extra server. In comfyui mode ComfyUI handles CORS itself and enable_cross_origin_requests does nothing: start ComfyUI with --enable-cors-header if OpenOutpaint is served from another origin (including another localhost port)."}),
+                "prompt_submission": (VALID_SUBMIT_MODES, {"default": SUBMITMODES.WEBUI, "tooltip": "webui: requests are queued through the open ComfyUI browser tab. headless: requests queue a copy of this workflow as it was last run directly on the server, no browser tab needed."}),
+                "max_requests_per_endpoint": ("INT", {"default": 0, "min": 0, "max": 1024, "tooltip": "Max in-flight and queued requests per API endpoint, extra requests get a 429 with Retry-After. 0 = no limit."}),
+                "request_timeout": ("INT", {"default": 0, "min": 0, "max": 86400, "tooltip": "Seconds before an open request is answered with an error (504) and freed, eg. when the workflow errored. 0 = wait forever, rerun the workflow to finish stuck requests."}),
+                "preview_format": (PREVIEW_FORMATS, {"default": "PNG", "tooltip": "Encoding of latent previews sent to OpenOutpaint. JPEG and WEBP are much cheaper to encode than PNG."}),
+                "preview_quality": ("INT", {"default": 85, "min": 1, "max": 100, "tooltip": "Quality for JPEG and WEBP previews."}),
+                "preview_min_interval": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 60.0, "step": 0.1, "tooltip": "Minimum seconds between encoding new previews, progress polls in between get the last encoded one."}),
+                "encode_workers": ("INT", {"default": DEFAULT_ENCODE_WORKERS, "min": 1, "max": 64, "tooltip": "Threads used to encode a batch of output images in parallel. 1 = encode one after another."}),
+                "output_codec": (OUTPUT_CODECS, {"default": "png", "tooltip": "Codec for generated images. png: PIL. png_cv2: faster PNG encoder. webp_lossless: smaller, slower. webp_cv2: lossy WebP at output_quality (101 = lossless). Requests can override with output_codec, output_compress_level and output_quality fields."}),
+                "output_compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "tooltip": "PNG zlib level 0-9, or WebP lossless effort 0-6. Lower is faster to encode but bigger."}),
+                "output_quality": ("INT", {"default": 90, "min": 1, "max": 101, "tooltip": "Quality for webp_cv2, 101 = lossless."}),
+                "decode_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "tooltip": "Memory budget in MB for reusing decoded init images and masks that OpenOutpaint sends again, eg. for rerolls. 0 = disabled."}),
+                "coalesce_window": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 10.0, "step": 0.05, "tooltip": "Seconds to hold txt2img requests with a random seed, so ones that only differ in batch_size run as one workflow batch. 0 = disabled."}),
+                "coalesce_max_batch_size": ("INT", {"default": 8, "min": 1, "max": 256, "tooltip": "A merged txt2img batch is run as soon as it reaches this size."}),
+                "result_cache_mb": ("INT", {"default": 0, "min": 0, "max": 65536, "tooltip": "Memory budget in MB for reusing responses to identical txt2img/img2img requests with a fixed seed, eg. on undo/redo. 0 = disabled."}),
+                "result_cache_ttl": ("INT", {"default": 3600, "min": 0, "max": 604800, "tooltip": "Seconds a cached response stays valid. 0 = until evicted."}),
+                "workflow_version": ("STRING", {"default": "1", "tooltip": "Part of the result cache key, change it whenever the workflow changes what it renders."}),
+                "compress_responses": ("BOOLEAN", {"default": True, "tooltip": "Gzip/deflate the model, style and other list replies for clients that accept it. Saves bandwidth on remote setups."}),
             },
             "optional": {
                 "oop_styles": ("OOP_STYLES", {}),
                 "oop_checkpoints": ("OOP_CHECKPOINTS", {}),
             },
-            "hidden": {"unique_id": "UNIQUE_ID"},
+            "hidden": {"unique_id": "UNIQUE_ID", "prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
 
     RETURN_TYPES = ("OOP_REQUEST", "STRING")
@@ -51,7 +69,13 @@ class OpenOutpainterServing:
 
     def serve(
         self, run_server, server_address, port, enable_cross_origin_requests, request_id, spammy_debug,
-        unique_id,
+        unique_id, server_mode = SERVERMODES.THREADING, prompt_submission = SUBMITMODES.WEBUI,
+        max_requests_per_endpoint = 0, request_timeout = 0,
+        preview_format = "PNG", preview_quality = 85, preview_min_interval = 0.0,
+        encode_workers = DEFAULT_ENCODE_WORKERS, output_codec = "png", output_compress_level = 6, output_quality = 90,
+        decode_cache_mb = 0, coalesce_window = 0.0, coalesce_max_batch_size = 8,
+        result_cache_mb = 0, result_cache_ttl = 3600, workflow_version = "1", compress_responses = True,
+        prompt = None, extra_pnginfo = None,
         oop_styles = None, oop_checkpoints = None,
     ):
         print(f"{self.NAME} start - unique_id: {unique_id}")
@@ -67,18 +91,37 @@ class OpenOutpainterServing:
         oop_serving.oop_checkpoints = oop_checkpoints or ["Placeholder_Checkpoint_Name"]
         print(f"oop_checkpoints: {oop_checkpoints}")
 
+        # pre-serialized GET replies, unchanged lists keep their ETag
+        oop_serving.update_static_responses()
+
+        # headless submission queues a copy of this workflow, keep it up to date with the last run
+        oop_serving.submit_mode = prompt_submission
+        oop_serving.capture_prompt(prompt, extra_pnginfo)
+
+        # admission control and timeouts don't need a restart
+        oop_serving.max_requests_per_endpoint = max_requests_per_endpoint
+        oop_serving.request_timeout = request_timeout
+        oop_serving.coalescer.window = coalesce_window
+        oop_serving.coalescer.max_batch_size = coalesce_max_batch_size
+        oop_serving.result_cache.set_limits(result_cache_mb * 1024 * 1024, result_cache_ttl, workflow_version)
+        oop_serving.compress_responses = compress_responses
+
+        # decoded input image cache
+        decode_cache.set_max_bytes(decode_cache_mb * 1024 * 1024)
+
+        # preview encoding
+        oop_serving.progress.preview_settings.format = preview_format
+        oop_serving.progress.preview_settings.quality = preview_quality
+        oop_serving.progress.preview_settings.min_interval = preview_min_interval
+
         # server settings changed, restart
-        if oop_serving.http_running and (
-            not run_server or
-            oop_serving.server_address != server_address or
-            oop_serving.port != port or
-            oop_serving.enable_cross_origin_requests != enable_cross_origin_requests or
-            oop_serving.spammy_debug != spammy_debug
+        if oop_serving.http_running and oop_serving.needs_restart(
+            run_server, server_address, port, enable_cross_origin_requests, spammy_debug, server_mode,
         ):
             oop_serving.stop_server()
 
-        # start server
-        if run_server and not oop_serving.http_running:
+        # start server, or update settings that don't need a restart
+        if run_server:
             oop_serving.start_server(
                 server_address=server_address,
                 port=port,
@@ -86,6 +129,7 @@ class OpenOutpainterServing:
                 node_type=OpenOutpainterServing.CLASSNAME,
                 node_id=unique_id,
                 spammy_debug=spammy_debug,
+                server_mode=server_mode,
             )
 
         oop_request = oop_serving.get_data(request_id)
@@ -95,6 +139,9 @@ class OpenOutpainterServing:
         else:
             oop_request.extra_data["oop_styles"] = oop_styles
             oop_request.extra_data["oop_checkpoints"] = oop_checkpoints # not currently used
+            oop_request.extra_data["encode_workers"] = encode_workers
+            oop_request.extra_data["encode_settings"] = EncodeSettings(output_codec, output_compress_level, output_quality)
+            oop_request.build_routing_index()
 
         return (oop_request, oop_serving.server_status)
 
@@ -73,8 +73,9 @@ class OpenOutpainterServingStyleGet:
     FUNCTION = "out"
 
     def out(self, oop_request, style_name, empty_strings_on_false):
-        request_data = oop_request.request_data
-        if "styles" not in request_data:
+        # set lookup in the request's routing index, built once in serve()
+        selected = oop_request.has_style(style_name)
+        if selected is None:
             return (
                 ExecutionBlocker(None), # oop_request_if_true
                 ExecutionBlocker(None), # oop_request_if_false
@@ -82,9 +83,8 @@ class OpenOutpainterServingStyleGet:
                 "" if empty_strings_on_false else ExecutionBlocker(None), # prompt
                 "" if empty_strings_on_false else ExecutionBlocker(None), # negative_prompt
             )
-        styles = request_data["styles"]
         oop_styles = oop_request.extra_data["oop_styles"]
-        if style_name in styles and style_name in oop_styles:
+        if selected:
             return (
                 oop_request, # oop_request_if_true
                 ExecutionBlocker(None), # oop_request_if_false
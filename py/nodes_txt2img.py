@@ -1,7 +1,8 @@
 import json
 from comfy_execution.graph import ExecutionBlocker
 from .utils import get_category, images_to_base64
-from .api_server import POSTPATHS
+from .api_server import POSTPATHS, routes
+from .request_coalescer import finalize_members
 
 
 ########################
@@ -153,8 +154,15 @@ class OpenOutpainterServingOutputTXT2IMG:
     def out(self, oop_request, images=None, SEEDS=None):
         print(f"{self.NAME} out '{self.command_name}' images: {bool(images is not None)}")
         if images is not None and SEEDS is not None and oop_request[0].is_command(self.command_name):
+            base64_images = images_to_base64(
+                images,
+                oop_request[0].extra_data.get("encode_workers"),
+                oop_request[0].get_encode_settings(),
+            )
+            if oop_request[0].members:
+                finalize_members(oop_request[0], base64_images, SEEDS)
             response = {
-                "images": images_to_base64(images),
+                "images": base64_images,
                 "info": json.dumps({"all_seeds": SEEDS}, default=lambda o: None)
             }
             oop_request[0].finalize(response)
@@ -166,6 +174,9 @@ class OpenOutpainterServingOutputTXT2IMG:
 #########################
 # I'm lazy and don't want to define a bunch of duplicate data in separate file to register nodes.
 
+# the API route the nodes above answer, requests to it are queued for the workflow
+routes.add_workflow(POSTPATHS.PATH_TXT2IMG)
+
 def get_nodes():
     return [
         OpenOutpainterServingInputTXT2IMG,
@@ -1,6 +1,6 @@
 from comfy_execution.graph import ExecutionBlocker
-from .utils import get_category, base64_to_image, image_to_base64
-from .api_server import POSTPATHS
+from .utils import get_category, image_to_base64
+from .api_server import POSTPATHS, routes
 
 
 ########################
@@ -54,7 +54,7 @@ class OpenOutpainterServingInputUpscale:
         if not oop_request.is_command(self.command_name):
             return (ExecutionBlocker(None), ExecutionBlocker(None))
         return (
-            base64_to_image(oop_request.request_data["image"]),
+            oop_request.get_image("image"),
             float(oop_request.request_data["upscaling_resize"]),
         )
 
@@ -91,7 +91,7 @@ class OpenOutpainterServingOutputUpscale:
     def out(self, oop_request, image=None):
         print(f"{self.NAME} out '{self.command_name}' image: {bool(image is not None)}")
         if image is not None and oop_request.is_command(self.command_name):
-            response = {"image": image_to_base64(image)}
+            response = {"image": image_to_base64(image, oop_request.get_encode_settings())}
             oop_request.finalize(response)
         return {}
 
@@ -101,6 +101,9 @@ class OpenOutpainterServingOutputUpscale:
 #########################
 # I'm lazy and don't want to define a bunch of duplicate data in separate file to register nodes.
 
+# the API route the nodes above answer, requests to it are queued for the workflow
+routes.add_workflow(POSTPATHS.PATH_UPSCALE)
+
 def get_nodes():
     return [
         OpenOutpainterServingInputUpscale,
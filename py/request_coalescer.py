@@ -0,0 +1,117 @@
+import json
+import threading
+
+
+###########################
+#     Request Coalescer   #
+###########################
+# micro-batching of txt2img requests
+# requests that only differ in batch_size and use a random seed are held for a short window
+# and merged into one request with the summed batch_size, so the workflow runs once for all of them.
+# OpenOutpainterServingOutputTXT2IMG splits the output back to each member with finalize_members.
+
+# None if batch_size isn't a positive integer, those requests are never merged
+def parse_batch_size(data):
+    try:
+        batch_size = int(data.get("batch_size", 1))
+    except (TypeError, ValueError):
+        return None
+    return batch_size if batch_size > 0 else None
+
+
+class RequestCoalescer:
+    def __init__(self, manager, path):
+        self.manager = manager
+        self.path = path # only requests to this path are merged
+        self.lock = threading.Lock()
+        self.groups = {} # key: {"members", "batch_size", "timer"}
+        self.window = 0.0 # seconds to hold requests, 0 = disabled
+        self.max_batch_size = 8 # merged batch is sent as soon as it reaches this
+
+    def group_key(self, request):
+        if request.path != self.path:
+            return None
+        data = request.request_data
+        # fixed seeds would give different images when merged into one batch
+        if str(data.get("seed", -1)).strip() != "-1":
+            return None
+        return json.dumps({key: value for key, value in data.items() if key not in ("batch_size", "force_task_id")}, sort_keys=True, default=str)
+
+    # returns True if the request is held to be merged, otherwise the caller queues it as usual
+    def add(self, request):
+        if self.window <= 0:
+            return False
+        batch_size = parse_batch_size(request.request_data)
+        if batch_size is None:
+            return False
+        key = self.group_key(request)
+        if key is None:
+            return False
+        flush_now = False
+        with self.lock:
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = {"members": [], "batch_size": 0, "timer": threading.Timer(self.window, self.flush, (key,))}
+                group["timer"].daemon = True
+                group["timer"].start()
+            group["members"].append(request)
+            group["batch_size"] += batch_size
+            flush_now = group["batch_size"] >= self.max_batch_size
+        if flush_now:
+            self.flush(key)
+        return True
+
+    def flush(self, key):
+        with self.lock:
+            group = self.groups.pop(key, None)
+        if group is None:
+            return
+        group["timer"].cancel()
+        # members may have been cancelled or timed out while held
+        members = [member for member in group["members"] if not member.finalized]
+        if not members:
+            return
+        if len(members) == 1:
+            self.manager.queue_prompt(members[0])
+            return
+
+        data = dict(members[0].request_data)
+        data.pop("force_task_id", None) # the members keep their own
+        data["batch_size"] = sum(parse_batch_size(member.request_data) for member in members)
+        leader = self.manager.requests.create(data, members[0].path, counted=False)
+        leader.members = members
+        # nobody waits on the leader over http, so it cleans itself up, progress included
+        leader.add_done_callback(self.release_leader)
+        print(f"OpenOutpaint API server, merged request_ids: {[member.id for member in members]} into request_id: {leader.id} batch_size: {data['batch_size']}")
+        self.manager.queue_prompt(leader)
+
+    def release_leader(self, leader):
+        self.manager.requests.remove(leader.id)
+        self.manager.progress.remove_request(leader.id)
+
+
+# indexes of each member's images in the merged output
+# images come out as n_iter runs of the summed batch_size, member order within each run
+# if the output doesn't line up with the merged batch, everyone gets everything
+def split_member_indexes(batch_sizes, image_count):
+    total = sum(batch_sizes)
+    if total <= 0 or image_count % total != 0:
+        return [list(range(image_count)) for _ in batch_sizes]
+    member_indexes = []
+    offset = 0
+    for batch_size in batch_sizes:
+        member_indexes.append([start + offset + i for start in range(0, image_count, total) for i in range(batch_size)])
+        offset += batch_size
+    return member_indexes
+
+# request was merged from several API requests, give each its share of every iteration's batch
+def finalize_members(oop_request, base64_images, seeds):
+    members = oop_request.members
+    member_indexes = split_member_indexes([parse_batch_size(member.request_data) or 1 for member in members], len(base64_images))
+    seeds_per_image = len(seeds) == len(base64_images)
+    for member, indexes in zip(members, member_indexes):
+        member_seeds = [seeds[i] for i in indexes] if seeds_per_image else seeds
+        member.finalize({
+            "images": [base64_images[i] for i in indexes],
+            "info": json.dumps({"all_seeds": member_seeds}, default=lambda o: None)
+        })
@@ -0,0 +1,289 @@
+import re
+import json
+import binascii
+import numpy as np
+
+
+################################
+#     Streaming POST Parser    #
+################################
+# img2img bodies carry multi-megabyte base64 "init_images" and "mask" strings.
+# Buffering the body, decoding it to a str and json.loads-ing it holds several copies of them,
+# so instead the body is fed through this parser in chunks:
+# - image fields are base64 decoded as they arrive, only the decoded image file bytes are kept,
+#   as uint8 arrays that utils.base64_to_image/base64_to_mask accept in place of base64 strings
+# - everything else is small and is collected as raw json text and json.loads-ed per field
+# Empty image strings stay "" so checks like `if request_data["mask"]` keep working.
+
+STREAMED_FIELDS = ("init_images", "mask", "image")
+READ_CHUNK_SIZE = 1 << 16
+
+_WHITESPACE = b" \t\r\n"
+_RAW_SPECIAL = re.compile(rb'["\[\]{},]')
+_STRING_SPECIAL = re.compile(rb'["\\]')
+_NOT_BASE64 = re.compile(rb'[^A-Za-z0-9+/=]')
+_STRING_ESCAPES = {ord('/'): b"/", ord('n'): b"", ord('r'): b"", ord('t'): b""} # base64 only ever needs these
+
+
+class _Base64StreamDecoder:
+    def __init__(self):
+        self.output = bytearray()
+        self.pending = b"" # base64 chars not yet making up a full 4 char group
+        self.head = bytearray() # start of the string, until we know if it's a data url
+        self.checked_prefix = False
+
+    def write(self, data):
+        if not self.checked_prefix:
+            self.head += data
+            if self.head.startswith(b"data:"):
+                comma = self.head.find(b",")
+                if comma < 0:
+                    if len(self.head) > 256:
+                        raise ValueError("Invalid data url in image field")
+                    return
+                data = bytes(self.head[comma + 1:])
+            elif len(self.head) < 5 and b"data:".startswith(bytes(self.head)):
+                return # could still turn out to be a data url
+            else:
+                data = bytes(self.head)
+            self.checked_prefix = True
+            self.head = None
+        if _NOT_BASE64.search(data):
+            data = _NOT_BASE64.sub(b"", data)
+        data = self.pending + data
+        cut = len(data) - len(data) % 4
+        if cut:
+            self.output += binascii.a2b_base64(data[:cut])
+        self.pending = data[cut:]
+
+    def finish(self):
+        if not self.checked_prefix:
+            head = bytes(self.head)
+            self.head = bytearray()
+            self.checked_prefix = True
+            if head.startswith(b"data:"):
+                head = head[head.find(b",") + 1:] if b"," in head else b""
+            self.write(head)
+        if self.pending:
+            self.output += binascii.a2b_base64(self.pending + b"=" * (-len(self.pending) % 4))
+            self.pending = b""
+        if not self.output:
+            return ""
+        return np.frombuffer(self.output, np.uint8)
+
+
+class StreamingRequestParser:
+    def __init__(self, streamed_fields = STREAMED_FIELDS):
+        self.streamed_fields = streamed_fields
+        self.result = {}
+        self.state = "start"
+        self.buffer = b"" # unconsumed bytes, only ever a few bytes between feeds
+        self.key = None
+        self.raw = bytearray() # raw json text of the current key or value
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.decoder = None
+        self.array = None # list being filled when an image field is an array
+
+    def feed(self, chunk):
+        buffer = self.buffer + chunk if self.buffer else chunk
+        pos = 0
+        end = len(buffer)
+        while pos < end:
+            state = self.state
+
+            if state == "raw":
+                pos = self.scan_raw(buffer, pos, end)
+                continue
+            if state == "key":
+                pos = self.scan_key(buffer, pos, end)
+                continue
+            if state == "stream_string":
+                next_pos = self.scan_stream_string(buffer, pos, end)
+                if next_pos == pos:
+                    break # escape split over chunks, wait for more data
+                pos = next_pos
+                continue
+
+            c = buffer[pos]
+            if c in _WHITESPACE:
+                pos += 1
+                continue
+
+            if state == "start":
+                self.expect(c, b"{")
+                self.state = "first_key"
+            elif state == "first_key":
+                if c == ord("}"):
+                    self.state = "end"
+                else:
+                    self.expect(c, b'"')
+                    self.state = "key"
+            elif state == "next_key":
+                self.expect(c, b'"')
+                self.state = "key"
+            elif state == "colon":
+                self.expect(c, b":")
+                self.state = "value"
+            elif state == "value":
+                if self.key in self.streamed_fields and c == ord('"'):
+                    self.array = None
+                    self.decoder = _Base64StreamDecoder()
+                    self.state = "stream_string"
+                elif self.key in self.streamed_fields and c == ord("["):
+                    self.array = []
+                    self.state = "array_first"
+                else:
+                    # not consumed here, scan_raw collects it
+                    self.raw = bytearray()
+                    self.depth = 0
+                    self.in_string = False
+                    self.escaped = False
+                    self.state = "raw"
+                    continue
+            elif state == "after_value":
+                if c == ord("}"):
+                    self.state = "end"
+                else:
+                    self.expect(c, b",")
+                    self.state = "next_key"
+            elif state in ("array_first", "array_item"):
+                if c == ord("]") and state == "array_first":
+                    self.store(self.array)
+                else:
+                    self.expect(c, b'"') # only arrays of strings are streamed
+                    self.decoder = _Base64StreamDecoder()
+                    self.state = "stream_string"
+            elif state == "array_after_item":
+                if c == ord("]"):
+                    self.store(self.array)
+                else:
+                    self.expect(c, b",")
+                    self.state = "array_item"
+            elif state == "end":
+                raise ValueError("Unexpected data after end of JSON object")
+            pos += 1
+
+        self.buffer = buffer[pos:]
+
+    def close(self):
+        if self.state != "end" or self.buffer.strip(_WHITESPACE):
+            raise ValueError("Incomplete JSON request body")
+        return self.result
+
+    ###################
+    #     Helpers     #
+    ###################
+
+    def expect(self, c, expected):
+        if c != expected[0]:
+            raise ValueError(f"Invalid JSON request body, expected {expected!r} got {bytes([c])!r}")
+
+    def store(self, value):
+        self.result[self.key] = value
+        self.raw = bytearray()
+        self.escaped = False
+        self.state = "after_value"
+
+    def scan_key(self, buffer, pos, end):
+        # keys are short, escapes are handled by json.loads once the key is complete
+        while pos < end:
+            c = buffer[pos]
+            pos += 1
+            if self.escaped:
+                self.escaped = False
+            elif c == ord("\\"):
+                self.escaped = True
+            elif c == ord('"'):
+                self.key = json.loads(b'"' + bytes(self.raw) + b'"')
+                self.raw = bytearray()
+                self.state = "colon"
+                return pos
+            self.raw.append(c)
+        return pos
+
+    # collect a non-image value as raw json text until it ends at depth 0
+    def scan_raw(self, buffer, pos, end):
+        while pos < end:
+            if self.escaped:
+                self.raw.append(buffer[pos])
+                self.escaped = False
+                pos += 1
+                continue
+            match = (_STRING_SPECIAL if self.in_string else _RAW_SPECIAL).search(buffer, pos, end)
+            if match is None:
+                self.raw += buffer[pos:end]
+                return end
+            index = match.start()
+            self.raw += buffer[pos:index]
+            c = buffer[index]
+            if self.in_string:
+                if c == ord("\\"):
+                    self.escaped = True
+                else:
+                    self.in_string = False
+            elif c == ord('"'):
+                self.in_string = True
+            elif c in b"[{":
+                self.depth += 1
+            elif c in b"]}":
+                if self.depth == 0:
+                    # closing the request object itself, value ended before it
+                    self.store(json.loads(bytes(self.raw)))
+                    return index
+                self.depth -= 1
+            elif c == ord(",") and self.depth == 0:
+                self.store(json.loads(bytes(self.raw)))
+                return index
+            self.raw.append(c)
+            pos = index + 1
+        return pos
+
+    # feed base64 text straight into the decoder, stops at an escape split over chunks
+    def scan_stream_string(self, buffer, pos, end):
+        while pos < end:
+            match = _STRING_SPECIAL.search(buffer, pos, end)
+            if match is None:
+                self.decoder.write(buffer[pos:end])
+                return end
+            index = match.start()
+            if index > pos:
+                self.decoder.write(buffer[pos:index])
+            if buffer[index] == ord('"'):
+                value = self.decoder.finish()
+                self.decoder = None
+                if self.array is not None:
+                    self.array.append(value)
+                    self.state = "array_after_item"
+                else:
+                    self.store(value)
+                return index + 1
+            # backslash escape
+            if index + 1 >= end:
+                return index # keep the backslash for the next feed
+            escaped = _STRING_ESCAPES.get(buffer[index + 1])
+            if escaped is None:
+                raise ValueError("Unexpected escape in image field")
+            if escaped:
+                self.decoder.write(escaped)
+            pos = index + 2
+        return pos
+
+
+def parse_request_body(read, content_length, chunk_size = READ_CHUNK_SIZE):
+    parser = StreamingRequestParser()
+    remaining = content_length
+    while remaining > 0:
+        chunk = read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        parser.feed(chunk)
+    return parser.close()
+
+async def parse_request_body_async(content, chunk_size = READ_CHUNK_SIZE):
+    parser = StreamingRequestParser()
+    async for chunk in content.iter_chunked(chunk_size):
+        parser.feed(chunk)
+    return parser.close()
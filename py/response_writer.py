@@ -0,0 +1,190 @@
+import re
+import json
+import gzip
+import zlib
+import time
+import hashlib
+from email.utils import formatdate
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+###################################
+#     Streaming JSON Responses    #
+###################################
+# txt2img/img2img responses are mostly multi-megabyte base64 image strings.
+# json.dumps(response).encode('utf-8') makes two more full copies of all of them
+# and writes the lot in one go, so instead the response is split into parts:
+# - large base64 strings are kept as references and written in slices, base64 never needs
+#   escaping so they are copied into the output as is
+# - everything in between is small and serialized with orjson when installed, else json
+# The total size is known up front, so responses keep a normal Content-Length.
+
+LARGE_STRING_SIZE = 1 << 16
+WRITE_CHUNK_SIZE = 1 << 20
+
+_NOT_BASE64_SAFE = re.compile(r'[^A-Za-z0-9+/=]')
+
+
+def _dumps_small(value):
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            pass # eg. int dict keys, let json handle those
+    return json.dumps(value).encode('utf-8')
+
+
+def _is_raw_string(value):
+    return isinstance(value, str) and len(value) >= LARGE_STRING_SIZE and not _NOT_BASE64_SAFE.search(value)
+
+
+class JsonResponseBody:
+    def __init__(self, data):
+        self.parts = [] # bytes, or large str written without escaping
+        self.pending = bytearray() # small parts are joined until the next large string
+        self.collect(data)
+        self.flush()
+        self.content_length = sum(len(part) + 2 if isinstance(part, str) else len(part) for part in self.parts)
+
+    def collect(self, value):
+        if isinstance(value, dict):
+            if not any(self.needs_split(item) for item in value.values()):
+                self.pending += _dumps_small(value)
+                return
+            self.pending += b"{"
+            for index, (key, item) in enumerate(value.items()):
+                if index:
+                    self.pending += b","
+                self.pending += _dumps_small(str(key))
+                self.pending += b":"
+                self.collect(item)
+            self.pending += b"}"
+        elif isinstance(value, (list, tuple)):
+            if not any(self.needs_split(item) for item in value):
+                self.pending += _dumps_small(value)
+                return
+            self.pending += b"["
+            for index, item in enumerate(value):
+                if index:
+                    self.pending += b","
+                self.collect(item)
+            self.pending += b"]"
+        elif _is_raw_string(value):
+            self.flush()
+            self.parts.append(value)
+        else:
+            self.pending += _dumps_small(value)
+
+    # only containers holding large strings are walked, the rest is serialized in one call
+    def needs_split(self, value):
+        if isinstance(value, dict):
+            return any(self.needs_split(item) for item in value.values())
+        if isinstance(value, (list, tuple)):
+            return any(self.needs_split(item) for item in value)
+        return _is_raw_string(value)
+
+    def flush(self):
+        if self.pending:
+            self.parts.append(bytes(self.pending))
+            self.pending = bytearray()
+
+    def __iter__(self):
+        for part in self.parts:
+            if not isinstance(part, str):
+                yield part
+                continue
+            yield b'"'
+            for start in range(0, len(part), WRITE_CHUNK_SIZE):
+                yield part[start:start + WRITE_CHUNK_SIZE].encode('ascii')
+            yield b'"'
+
+
+def write_json_body(write, data):
+    body = data if isinstance(data, JsonResponseBody) else JsonResponseBody(data)
+    for chunk in body:
+        write(chunk)
+
+
+#######################
+#     Compression     #
+#######################
+# the model, style and controlnet lists are plain JSON and compress well,
+# previews and generated images are already compressed and are never passed through here
+
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_LEVEL = 5
+COMPRESS_ENCODINGS = ("gzip", "deflate")
+
+def negotiate_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in COMPRESS_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compress_body(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, COMPRESS_LEVEL)
+    if encoding == "deflate":
+        return zlib.compress(body, COMPRESS_LEVEL)
+    return body
+
+
+##########################
+#     Static Responses    #
+##########################
+# GET replies that only change when the serving node changes them (styles, checkpoints and
+# the A1111 placeholder lists) are serialized once and served from bytes,
+# polling clients revalidate with If-None-Match and get a 304 without any body.
+# each encoding is a different body, so each gets its own ETag, eg. "<hash>-gzip"
+
+class StaticResponse:
+    def __init__(self, data, previous = None):
+        self.body = json.dumps(data).encode('utf-8')
+        self.digest = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        # unchanged content keeps its old Last-Modified
+        if previous is not None and previous.digest == self.digest:
+            self.last_modified = previous.last_modified
+        else:
+            self.last_modified = formatdate(time.time(), usegmt=True)
+        self.encoded = {None: self.body} # encoding: body, compressed on first request
+
+    def get_body(self, encoding = None):
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = self.encoded[encoding] = compress_body(self.body, encoding)
+        return body
+
+    def etag(self, encoding = None):
+        if encoding is None:
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{encoding}"'
+
+    def not_modified(self, if_none_match, if_modified_since, encoding = None):
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or self.etag(encoding) in tags
+        return bool(if_modified_since) and if_modified_since == self.last_modified
+
+    def headers(self, encoding = None):
+        return {
+            'ETag': self.etag(encoding),
+            'Last-Modified': self.last_modified,
+            'Cache-Control': 'no-cache', # always revalidate, the body changes when the workflow does
+        }
@@ -0,0 +1,118 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+##########################
+#     Result Cache       #
+##########################
+# opt-in cache of finished responses for requests that will render the same thing again,
+# OOP re-sends identical requests on undo/redo and page reloads.
+# only fixed seed txt2img/img2img requests are cached, keyed on the whole request body
+# (images by their hash) plus the workflow version set on the serving node,
+# bump that whenever the workflow changes what it renders.
+
+IMAGE_FIELDS = ("init_images", "mask", "image")
+
+
+# base64 text, or image file bytes the streaming request parser already decoded
+# anything else (eg. "mask": null) counts as an empty field
+def _image_digest(value):
+    if isinstance(value, str):
+        value = value.encode('ascii', 'replace')
+    elif not isinstance(value, (bytes, bytearray, memoryview, np.ndarray)):
+        return ""
+    if not len(value):
+        return ""
+    return hashlib.blake2b(value, digest_size=16).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cacheable_paths = ()):
+        self.cacheable_paths = tuple(cacheable_paths)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key: (created_time, size, output)
+        self.max_bytes = 0 # 0 = disabled
+        self.ttl = 0 # seconds, 0 = no expiry
+        self.workflow_version = ""
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def canonical_value(key, value):
+        if key not in IMAGE_FIELDS:
+            return value
+        if isinstance(value, list):
+            return [_image_digest(item) for item in value]
+        return _image_digest(value)
+
+    # None if the request can't be cached
+    def make_key(self, path, data):
+        if self.max_bytes <= 0 or path not in self.cacheable_paths:
+            return None
+        if str(data.get("seed", -1)).strip() == "-1":
+            return None
+        canonical = {key: self.canonical_value(key, value) for key, value in data.items() if key != "force_task_id"}
+        text = json.dumps([path, self.workflow_version, canonical], sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl > 0 and time.time() - entry[0] > self.ttl:
+                self.remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    # only real renders are cached, anything without images (errors, cancels) would be replayed as is
+    def put(self, key, output):
+        if key is None or not isinstance(output, dict) or "error" in output:
+            return
+        if not output.get("images") and not output.get("image"):
+            return
+        size = sum(len(image) for image in output.get("images", [])) + len(str(output.get("image", "")))
+        with self.lock:
+            if size > self.max_bytes:
+                return
+            self.remove(key)
+            self.entries[key] = (time.time(), size, output)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def set_limits(self, max_bytes, ttl, workflow_version):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self.workflow_version = workflow_version
+            if max_bytes <= 0:
+                self.entries.clear()
+                self.bytes = 0
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
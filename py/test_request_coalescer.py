@@ -0,0 +1,185 @@
+import json
+import itertools
+import unittest
+from request_coalescer import RequestCoalescer, parse_batch_size, split_member_indexes, finalize_members
+
+
+##################################
+#     Request Coalescer Tests    #
+##################################
+# Standalone, run from this directory: python -m unittest test_request_coalescer
+# the manager side is a small in-memory stand in for the registry, progress tracker and prompt queue
+
+TXT2IMG = '/sdapi/v1/txt2img'
+IMG2IMG = '/sdapi/v1/img2img'
+
+class Request:
+    def __init__(self, id, request_data, path = TXT2IMG):
+        self.id = id
+        self.request_data = request_data
+        self.path = path
+        self.members = []
+        self.finalized = False
+        self.output = None
+        self.callbacks = []
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def finalize(self, output):
+        self.output = output
+        self.finalized = True
+        for callback in self.callbacks:
+            callback(self)
+
+class Registry:
+    def __init__(self):
+        self.ids = itertools.count(100)
+        self.requests = {}
+        self.uncounted = set()
+
+    def create(self, data, path, counted = True):
+        request = Request(next(self.ids), data, path)
+        self.requests[request.id] = request
+        if not counted:
+            self.uncounted.add(request.id)
+        return request
+
+    def remove(self, request_id):
+        self.requests.pop(request_id, None)
+
+class Progress:
+    def __init__(self):
+        self.request_prompts = {}
+
+    def remove_request(self, request_id):
+        self.request_prompts.pop(request_id, None)
+
+class Manager:
+    def __init__(self):
+        self.requests = Registry()
+        self.progress = Progress()
+        self.queued = []
+
+    def queue_prompt(self, request):
+        self.queued.append(request)
+
+def make_coalescer(window = 60, max_batch_size = 8):
+    manager = Manager()
+    coalescer = RequestCoalescer(manager, TXT2IMG)
+    coalescer.window = window
+    coalescer.max_batch_size = max_batch_size
+    return manager, coalescer
+
+def txt2img(id, **data):
+    return Request(id, {"prompt": "a", "seed": -1, **data})
+
+
+class GroupingTests(unittest.TestCase):
+    def test_not_held(self):
+        _, coalescer = make_coalescer(window = 0)
+        self.assertFalse(coalescer.add(txt2img(1)))
+        _, coalescer = make_coalescer()
+        self.assertFalse(coalescer.add(txt2img(1, seed = 5)))
+        self.assertFalse(coalescer.add(Request(2, {"prompt": "a", "seed": -1}, IMG2IMG)))
+        self.assertEqual(coalescer.groups, {})
+
+    def test_bad_batch_size_is_not_held(self):
+        _, coalescer = make_coalescer()
+        for batch_size in ["fast", None, [2], 0, -1]:
+            self.assertFalse(coalescer.add(txt2img(1, batch_size = batch_size)), batch_size)
+        self.assertEqual(coalescer.groups, {})
+
+    def test_group_key(self):
+        _, coalescer = make_coalescer()
+        key = coalescer.group_key(txt2img(1, batch_size = 1))
+        self.assertEqual(coalescer.group_key(txt2img(2, batch_size = 3, force_task_id = "task(x)")), key)
+        self.assertNotEqual(coalescer.group_key(txt2img(4, prompt = "b")), key)
+
+    def test_merges_held_requests(self):
+        manager, coalescer = make_coalescer()
+        members = [txt2img(1, batch_size = 2, force_task_id = "task(1)"), txt2img(2), txt2img(3, batch_size = "3")]
+        other = txt2img(4, prompt = "b")
+        for request in members + [other]:
+            self.assertTrue(coalescer.add(request))
+        self.assertEqual(len(coalescer.groups), 2)
+        for key in list(coalescer.groups):
+            coalescer.flush(key)
+        self.assertEqual(coalescer.groups, {})
+
+        leader, single = sorted(manager.queued, key=lambda request: not request.members)
+        self.assertIs(single, other)
+        self.assertEqual(leader.members, members)
+        self.assertEqual(leader.request_data["batch_size"], 6)
+        self.assertNotIn("force_task_id", leader.request_data)
+        self.assertIn(leader.id, manager.requests.uncounted)
+
+    def test_flushes_at_max_batch_size(self):
+        manager, coalescer = make_coalescer(max_batch_size = 4)
+        coalescer.add(txt2img(1, batch_size = 2))
+        self.assertEqual(manager.queued, [])
+        coalescer.add(txt2img(2, batch_size = 2))
+        self.assertEqual(len(manager.queued), 1)
+        self.assertEqual(manager.queued[0].request_data["batch_size"], 4)
+        self.assertEqual(coalescer.groups, {})
+
+    def test_finalized_members_are_dropped(self):
+        manager, coalescer = make_coalescer()
+        members = [txt2img(1), txt2img(2)]
+        for request in members:
+            coalescer.add(request)
+        members[0].finalize({"error": "Request timed out"})
+        coalescer.flush(next(iter(coalescer.groups)))
+        # a single member left runs as itself
+        self.assertEqual(manager.queued, [members[1]])
+
+    def test_leader_cleans_up_after_itself(self):
+        manager, coalescer = make_coalescer()
+        for request in [txt2img(1), txt2img(2)]:
+            coalescer.add(request)
+        coalescer.flush(next(iter(coalescer.groups)))
+        leader = manager.queued[0]
+        manager.progress.request_prompts[leader.id] = "p1"
+        leader.finalize({"images": []})
+        self.assertNotIn(leader.id, manager.requests.requests)
+        self.assertEqual(manager.progress.request_prompts, {})
+
+
+class SplitTests(unittest.TestCase):
+    def test_parse_batch_size(self):
+        self.assertEqual(parse_batch_size({}), 1)
+        self.assertEqual(parse_batch_size({"batch_size": "3"}), 3)
+        self.assertIsNone(parse_batch_size({"batch_size": "fast"}))
+        self.assertIsNone(parse_batch_size({"batch_size": 0}))
+
+    def test_split_member_indexes(self):
+        self.assertEqual(split_member_indexes([2, 1], 3), [[0, 1], [2]])
+        # n_iter runs of the merged batch
+        self.assertEqual(split_member_indexes([2, 1], 6), [[0, 1, 3, 4], [2, 5]])
+        self.assertEqual(split_member_indexes([1, 1, 1], 3), [[0], [1], [2]])
+        # output that doesn't line up goes to everyone
+        self.assertEqual(split_member_indexes([2, 1], 4), [[0, 1, 2, 3], [0, 1, 2, 3]])
+        self.assertEqual(split_member_indexes([2, 1], 0), [[], []])
+
+    def test_finalize_members(self):
+        leader = Request(100, {"batch_size": 3})
+        leader.members = [Request(1, {"batch_size": 2}), Request(2, {})]
+        finalize_members(leader, ["a0", "a1", "b0", "a2", "a3", "b1"], [10, 11, 12, 13, 14, 15])
+        first, second = [member.output for member in leader.members]
+        self.assertEqual(first["images"], ["a0", "a1", "a2", "a3"])
+        self.assertEqual(json.loads(first["info"]), {"all_seeds": [10, 11, 13, 14]})
+        self.assertEqual(second["images"], ["b0", "b1"])
+        self.assertEqual(json.loads(second["info"]), {"all_seeds": [12, 15]})
+
+    def test_finalize_members_seed_mismatch(self):
+        leader = Request(100, {"batch_size": 2})
+        leader.members = [Request(1, {}), Request(2, {})]
+        # one seed per iteration instead of per image, everyone gets the whole list
+        finalize_members(leader, ["a", "b"], [7])
+        for member, image in zip(leader.members, ["a", "b"]):
+            self.assertEqual(member.output["images"], [image])
+            self.assertEqual(json.loads(member.output["info"]), {"all_seeds": [7]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+import io
+import json
+import base64
+import random
+import asyncio
+import unittest
+import numpy as np
+from request_parser import StreamingRequestParser, parse_request_body, parse_request_body_async, STREAMED_FIELDS
+
+
+#####################################
+#     Streaming POST Parser Tests    #
+#####################################
+# The parser must give the same result as json.loads, except image fields hold the
+# base64 decoded bytes (as uint8 arrays) instead of the base64 text.
+# Standalone, run from this directory: python -m unittest test_request_parser
+
+CHUNK_SIZES = [1, 2, 3, 5, 7, 64, 4096, 1 << 20]
+
+def b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+def expected_image(value):
+    if not isinstance(value, str):
+        return value
+    if value.startswith("data:"):
+        value = value[value.index(",") + 1:]
+    return base64.b64decode(value) or "" # empty images stay "", data url or not
+
+def expected_result(body):
+    result = json.loads(body)
+    for key in STREAMED_FIELDS:
+        if key in result:
+            value = result[key]
+            result[key] = [expected_image(item) for item in value] if isinstance(value, list) else expected_image(value)
+    return result
+
+def normalize(result):
+    for key in STREAMED_FIELDS:
+        if key in result:
+            value = result[key]
+            convert = lambda item: item.tobytes() if isinstance(item, np.ndarray) else item
+            result[key] = [convert(item) for item in value] if isinstance(value, list) else convert(value)
+    return result
+
+def parse_chunked(body, chunk_size):
+    parser = StreamingRequestParser()
+    for start in range(0, len(body), chunk_size):
+        parser.feed(body[start:start + chunk_size])
+    return parser.close()
+
+
+random.seed(1234)
+IMAGE_A = random.randbytes(3000)
+IMAGE_B = random.randbytes(1001) # not a multiple of 3, so padded base64
+MASK = random.randbytes(17)
+
+
+class StreamingRequestParserTests(unittest.TestCase):
+    def assert_matches_json(self, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        expected = expected_result(body)
+        for chunk_size in CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(normalize(parse_chunked(body, chunk_size)), expected)
+
+    def assert_rejected(self, body, chunk_sizes = CHUNK_SIZES):
+        for chunk_size in chunk_sizes:
+            with self.subTest(body=body[:60], chunk_size=chunk_size):
+                with self.assertRaises(ValueError):
+                    parse_chunked(body, chunk_size)
+
+    ###################
+    #     Matching    #
+    ###################
+
+    def test_txt2img_body(self):
+        self.assert_matches_json(json.dumps({
+            "prompt": "a \"quoted\" prompt with \\ backslash\nnewline and unicode é中 \U0001f600",
+            "negative_prompt": "",
+            "seed": -1,
+            "cfg_scale": 7.5,
+            "batch_size": 2,
+            "restore_faces": False,
+            "tiling": None,
+            "styles": ["style one", "style,two", "sty]le{three}"],
+            "alwayson_scripts": {"controlnet": {"args": [{"enabled": True, "weight": 1.0}, []]}},
+        }))
+
+    def test_img2img_body(self):
+        self.assert_matches_json(json.dumps({
+            "prompt": "inpaint",
+            "init_images": ["data:image/png;base64," + b64(IMAGE_A), b64(IMAGE_B)],
+            "mask": "data:image/png;base64," + b64(MASK),
+            "denoising_strength": 0.75,
+            "inpainting_fill": 1,
+        }))
+
+    def test_single_image_field(self):
+        self.assert_matches_json(json.dumps({"image": b64(IMAGE_B), "model": "clip"}))
+
+    def test_empty_image_fields(self):
+        self.assert_matches_json(json.dumps({"init_images": [], "mask": "", "image": ""}))
+        self.assert_matches_json(json.dumps({"init_images": [""], "mask": "data:image/png;base64,"}))
+
+    def test_empty_object_and_whitespace(self):
+        self.assert_matches_json(b"{}")
+        self.assert_matches_json(b"  \r\n{ \"mask\" : \"\" ,\t\"seed\" :\n1 }\n ")
+
+    def test_image_escapes_split_over_chunks(self):
+        # json encoders may escape "/" and wrap base64 lines, every chunk size splits these somewhere
+        text = b64(IMAGE_A)
+        wrapped = "\\n".join(text[i:i + 76] for i in range(0, len(text), 76)).replace("/", "\\/")
+        self.assert_matches_json('{"mask": "' + wrapped + '", "init_images": ["' + wrapped + '\\r\\n"]}')
+
+    def test_escaped_keys(self):
+        self.assert_matches_json('{"pro\\u006dpt": "x", "m\\u0061sk": "", "quo\\"te": 1}')
+
+    def test_image_key_with_non_string_value(self):
+        # only strings and arrays of strings are streamed, anything else is parsed as plain json
+        self.assert_matches_json(json.dumps({"mask": None, "image": 5}))
+
+    def test_parse_request_body_reads_content_length(self):
+        body = json.dumps({"prompt": "p", "mask": b64(MASK)}).encode('utf-8')
+        for chunk_size in CHUNK_SIZES:
+            # anything past Content-Length belongs to the next request on the connection
+            result = parse_request_body(io.BytesIO(body + b"GET / HTTP/1.1").read, len(body), chunk_size)
+            self.assertEqual(normalize(result), expected_result(body))
+
+    def test_parse_request_body_async(self):
+        body = json.dumps({"init_images": [b64(IMAGE_A)], "seed": 3}).encode('utf-8')
+
+        class Content:
+            async def iter_chunked(self, size):
+                for start in range(0, len(body), 5):
+                    yield body[start:start + 5]
+
+        self.assertEqual(normalize(asyncio.run(parse_request_body_async(Content()))), expected_result(body))
+
+    ###################
+    #     Rejects     #
+    ###################
+
+    def test_truncated_bodies(self):
+        body = json.dumps({
+            "prompt": "p \"q\"",
+            "init_images": ["data:image/png;base64," + b64(IMAGE_B)],
+            "mask": b64(MASK),
+            "steps": [1, {"a": 2}],
+        }).encode('utf-8')
+        for end in range(len(body)):
+            self.assert_rejected(body[:end], [1, 7, 4096])
+        with self.assertRaises(ValueError):
+            parse_request_body(io.BytesIO(body[:-10]).read, len(body))
+
+    def test_malformed_bodies(self):
+        for body in [
+            b"",
+            b"[]",
+            b"{\"prompt\" \"x\"}",
+            b"{\"prompt\": \"x\" \"seed\": 1}",
+            b"{\"prompt\": \"x\",}",
+            b"{\"prompt\": \"x\"} {}",
+            b"{\"prompt\": x}",
+            b"{prompt: \"x\"}",
+            b"{\"init_images\": [1]}",
+            b"{\"init_images\": [\"QUFB\" \"QUFB\"]}",
+            b"{\"mask\": \"QU\\u0046B\"}",
+            b"{\"mask\": \"data:" + b"x" * 300 + b"\"}",
+        ]:
+            self.assert_rejected(body)
+
+
+if __name__ == "__main__":
+    unittest.main()
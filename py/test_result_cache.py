@@ -0,0 +1,136 @@
+import time
+import unittest
+import numpy as np
+from result_cache import ResultCache
+
+
+#############################
+#     Result Cache Tests    #
+#############################
+# Standalone, run from this directory: python -m unittest test_result_cache
+
+TXT2IMG = '/sdapi/v1/txt2img'
+IMG2IMG = '/sdapi/v1/img2img'
+
+def make_cache(max_bytes = 1 << 20, ttl = 0, workflow_version = "1"):
+    cache = ResultCache((TXT2IMG, IMG2IMG))
+    cache.set_limits(max_bytes, ttl, workflow_version)
+    return cache
+
+def rendered(*images):
+    return {"images": list(images), "parameters": {}, "info": ""}
+
+
+class ResultCacheKeyTests(unittest.TestCase):
+    def test_disabled_or_uncacheable(self):
+        self.assertIsNone(make_cache(0).make_key(TXT2IMG, {"seed": 5}))
+        self.assertIsNone(make_cache().make_key('/sdapi/v1/interrogate', {"seed": 5}))
+        # random seeds render something new every time
+        self.assertIsNone(make_cache().make_key(TXT2IMG, {"seed": -1}))
+        self.assertIsNone(make_cache().make_key(TXT2IMG, {"seed": " -1 "}))
+        self.assertIsNone(make_cache().make_key(TXT2IMG, {}))
+
+    def test_same_body_same_key(self):
+        cache = make_cache()
+        key = cache.make_key(TXT2IMG, {"seed": 5, "prompt": "a", "steps": 20})
+        self.assertIsNotNone(key)
+        self.assertEqual(cache.make_key(TXT2IMG, {"steps": 20, "prompt": "a", "seed": 5}), key)
+        # the task id only names the request, it doesn't change what is rendered
+        self.assertEqual(cache.make_key(TXT2IMG, {"seed": 5, "prompt": "a", "steps": 20, "force_task_id": "task(x)"}), key)
+
+    def test_key_changes(self):
+        cache = make_cache()
+        key = cache.make_key(TXT2IMG, {"seed": 5, "prompt": "a"})
+        self.assertNotEqual(cache.make_key(TXT2IMG, {"seed": 6, "prompt": "a"}), key)
+        self.assertNotEqual(cache.make_key(TXT2IMG, {"seed": 5, "prompt": "b"}), key)
+        self.assertNotEqual(cache.make_key(IMG2IMG, {"seed": 5, "prompt": "a"}), key)
+        cache.set_limits(1 << 20, 0, "2")
+        self.assertNotEqual(cache.make_key(TXT2IMG, {"seed": 5, "prompt": "a"}), key)
+
+    def test_image_fields(self):
+        cache = make_cache()
+        decoded = np.frombuffer(b"image bytes", np.uint8)
+        key = cache.make_key(IMG2IMG, {"seed": 5, "init_images": [decoded], "mask": "QUFB"})
+        self.assertEqual(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [np.frombuffer(b"image bytes", np.uint8)], "mask": "QUFB"}), key)
+        self.assertNotEqual(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [np.frombuffer(b"other bytes", np.uint8)], "mask": "QUFB"}), key)
+        self.assertNotEqual(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [decoded], "mask": "QUFC"}), key)
+
+    def test_empty_and_null_image_fields(self):
+        cache = make_cache()
+        key = cache.make_key(IMG2IMG, {"seed": 5, "init_images": [b"x"], "mask": ""})
+        # A1111 clients send "mask": null, that's the same as no mask
+        self.assertEqual(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [b"x"], "mask": None}), key)
+        self.assertEqual(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [b"x"], "mask": 0}), key)
+        self.assertIsNotNone(cache.make_key(IMG2IMG, {"seed": 5, "init_images": [None, ""], "image": None}))
+
+
+class ResultCacheEntryTests(unittest.TestCase):
+    def test_put_get(self):
+        cache = make_cache()
+        key = cache.make_key(TXT2IMG, {"seed": 5})
+        self.assertIsNone(cache.get(key))
+        output = rendered("QUFB", "QkJC")
+        cache.put(key, output)
+        self.assertIs(cache.get(key), output)
+        self.assertEqual(cache.stats()["entries"], 1)
+        self.assertEqual(cache.stats()["bytes"], 8)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertIsNone(cache.get(None))
+
+    def test_outputs_without_images_are_not_cached(self):
+        cache = make_cache()
+        key = cache.make_key(TXT2IMG, {"seed": 5})
+        for output in [
+            {}, # what cancelled requests used to be finalized with
+            {"error": "Request was cancelled"},
+            {"images": [], "info": ""},
+            {"image": ""},
+            rendered("QUFB") | {"error": "partial"},
+            None,
+            "QUFB",
+        ]:
+            cache.put(key, output)
+            self.assertIsNone(cache.get(key), output)
+        cache.put(None, rendered("QUFB"))
+        self.assertEqual(cache.stats()["entries"], 0)
+        cache.put(key, {"image": "QUFB"})
+        self.assertEqual(cache.get(key), {"image": "QUFB"})
+
+    def test_evicts_least_recently_used(self):
+        cache = make_cache(max_bytes = 12)
+        keys = [cache.make_key(TXT2IMG, {"seed": seed}) for seed in range(4)]
+        cache.put(keys[0], rendered("AAAA"))
+        cache.put(keys[1], rendered("BBBB"))
+        cache.put(keys[2], rendered("CCCC"))
+        cache.get(keys[0])
+        cache.put(keys[3], rendered("DDDD"))
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertEqual(cache.stats()["bytes"], 12)
+        # bigger than the whole budget
+        cache.put(keys[1], rendered("A" * 13))
+        self.assertIsNone(cache.get(keys[1]))
+
+    def test_ttl(self):
+        cache = make_cache(ttl = 60)
+        key = cache.make_key(TXT2IMG, {"seed": 5})
+        cache.put(key, rendered("QUFB"))
+        self.assertIsNotNone(cache.get(key))
+        _, size, output = cache.entries[key]
+        cache.entries[key] = (time.time() - 61, size, output)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+    def test_set_limits(self):
+        cache = make_cache()
+        key = cache.make_key(TXT2IMG, {"seed": 5})
+        cache.put(key, rendered("QUFB"))
+        cache.set_limits(0, 0, "1")
+        self.assertEqual(cache.stats()["entries"], 0)
+        self.assertEqual(cache.stats()["bytes"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
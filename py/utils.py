@@ -1,66 +1,293 @@
 import base64
+import binascii
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import hashlib
+import threading
+import os
+import re
+import time
+from functools import lru_cache
 from PIL import Image
 import numpy as np
 import torch
 import cv2
+from .metrics import metrics
 
 CATEGORYNAMESPACE = 'OpenOutpaint-Serving'
 
+image_decode_seconds = metrics.histogram("oop_image_decode_seconds", "Time to decode a request image or mask into a tensor", ("kind",))
+image_encode_seconds = metrics.histogram("oop_image_encode_seconds", "Time to encode an output image to base64", ("codec",))
+preview_encodes_total = metrics.counter("oop_preview_encodes_total", "Latent previews encoded for progress replies", ("format",))
+preview_encode_seconds = metrics.histogram("oop_preview_encode_seconds", "Time to encode a latent preview to base64", ("format",))
+
 def get_category(sub_dir = None):
     if sub_dir is None:
         return CATEGORYNAMESPACE
     else:
         return f"{CATEGORYNAMESPACE}/{sub_dir}"
 
-def _strip_prefix(s: str, prefix: str) -> str:
-    if s.startswith(prefix):
-        return s[len(prefix) :]
-    return s
-
-
-def convert_color(image):
-    if len(image.shape) > 2 and image.shape[2] >= 4:
-        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
-    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+# base64 (optionally a data url) to a cv2 image
+# also takes image file bytes the streaming request parser already decoded from base64
+def _decode_base64(base64_str, flags):
+    if not isinstance(base64_str, str):
+        return cv2.imdecode(np.frombuffer(base64_str, np.uint8), flags)
+    if base64_str.startswith("data:"):
+        # the slice copies the string once, only for data urls
+        base64_str = base64_str[base64_str.find(",", 0, 128) + 1:]
+    # a2b_base64 takes the ascii str directly, no encode() or b64decode validation copy
+    raw = binascii.a2b_base64(base64_str)
+    return cv2.imdecode(np.frombuffer(raw, np.uint8), flags)
 
+# decoded straight to 8-bit BGR, so any alpha channel is dropped before the float conversion,
+# then colour converted in place and normalized into the output tensor in one op
 def base64_to_image(base64_str):
-    base64_str = _strip_prefix(base64_str, "data:image/png;base64,")
-    nparr = np.frombuffer(base64.b64decode(base64_str), np.uint8)
-    result = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-    result = convert_color(result)
-    result = result.astype(np.float32) / 255.0
-    image = torch.from_numpy(result)[None,]
+    started = time.perf_counter()
+    result = _decode_base64(base64_str, cv2.IMREAD_COLOR)
+    cv2.cvtColor(result, cv2.COLOR_BGR2RGB, dst=result)
+    image = torch.empty((1, *result.shape), dtype=torch.float32)
+    torch.div(torch.from_numpy(result), 255.0, out=image[0])
+    image_decode_seconds.observe(time.perf_counter() - started, ("image",))
     return image
 
 def base64_to_mask(base64_str):
-    base64_str = _strip_prefix(base64_str, "data:image/png;base64,")
-    nparr = np.frombuffer(base64.b64decode(base64_str), np.uint8)
-    result = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-    result = result.astype(np.float32) / 255.0
-    image = torch.from_numpy(result)
-    if image.dim() == 3:  # RGB(A) input, use red channel
-        image = image[:, :, 0]
-    return image.unsqueeze(0)
-
-def image_to_base64(image):
-    img_np = (image.cpu().numpy() * 255).astype('uint8')
+    started = time.perf_counter()
+    result = _decode_base64(base64_str, cv2.IMREAD_UNCHANGED)
+    if result.ndim == 3:  # RGB(A) input, use first channel only, before any float conversion
+        result = result[:, :, 0]
+    if result.dtype != np.uint8:  # 16-bit png
+        result = cv2.convertScaleAbs(result, alpha=255.0 / 65535.0)
+    mask = torch.empty((1, *result.shape), dtype=torch.float32)
+    torch.div(torch.from_numpy(result), 255.0, out=mask[0])
+    image_decode_seconds.observe(time.perf_counter() - started, ("mask",))
+    return mask
+
+def resize_image(image, size):
+    # [B,H,W,C] to [B,size[0],size[1],C]
+    return torch.nn.functional.interpolate(image.movedim(-1, 1), size=size, mode="bilinear", align_corners=False).movedim(1, -1)
+
+# stack [1,H,W,C] images into one [B,H,W,C] batch, resizing any that differ to the first one's size
+def batch_images(images):
+    if len(images) == 1:
+        return images[0]
+    size = tuple(images[0].shape[1:3])
+    return torch.cat([image if tuple(image.shape[1:3]) == size else resize_image(image, size) for image in images], dim=0)
+
+# match a [1,H,W] mask to an image batch, as a broadcast view when the size already matches
+def batch_mask(mask, batch_size, size):
+    if tuple(mask.shape[1:3]) != tuple(size):
+        mask = torch.nn.functional.interpolate(mask.unsqueeze(1), size=size, mode="bilinear", align_corners=False).squeeze(1)
+    if mask.shape[0] == 1 and batch_size > 1:
+        mask = mask.expand(batch_size, -1, -1)
+    return mask
+
+# LRU cache of decoded images keyed by a hash of the raw payload,
+# OOP often resends the same canvas region or mask for rerolls and retries
+# tensors are shared between requests, so nodes must not modify them in place (ComfyUI nodes don't)
+class DecodeCache:
+    def __init__(self, max_bytes = 0):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # (kind, digest): tensor
+        self.max_bytes = max_bytes # 0 = disabled
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(data):
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def evict(self):
+        while self.entries and self.bytes > self.max_bytes:
+            _, tensor = self.entries.popitem(last=False)
+            self.bytes -= tensor.element_size() * tensor.nelement()
+
+    def get_or_decode(self, kind, data, decode):
+        if self.max_bytes <= 0:
+            return decode(data)
+        key = (kind, self.digest(data))
+        with self.lock:
+            tensor = self.entries.get(key)
+            if tensor is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return tensor
+            self.misses += 1
+        tensor = decode(data)
+        size = tensor.element_size() * tensor.nelement()
+        with self.lock:
+            if size <= self.max_bytes and key not in self.entries:
+                self.entries[key] = tensor
+                self.bytes += size
+                self.evict()
+        return tensor
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+decode_cache = DecodeCache()
+
+def cached_base64_to_image(base64_str):
+    return decode_cache.get_or_decode("image", base64_str, base64_to_image)
+
+def cached_base64_to_mask(base64_str):
+    return decode_cache.get_or_decode("mask", base64_str, base64_to_mask)
+
+# output image codecs
+# png: PIL, compress_level 0-9 (PIL default is 6)
+# png_cv2: cv2.imencode, usually faster than PIL at the same compress_level
+# webp_lossless: PIL lossless WebP, compress_level 0-6 is the encoder effort
+# webp_cv2: cv2.imencode WebP at quality 1-100, above 100 is lossless
+OUTPUT_CODECS = ["png", "png_cv2", "webp_lossless", "webp_cv2"]
+
+ENCODE_OVERRIDE_FIELDS = {"output_compress_level": (0, 9), "output_quality": (1, 101)} # field: (min, max)
+
+# request fields output_compress_level and output_quality as clamped ints, only the ones the request sets
+# raises ValueError for values that aren't integers, checked when the request is admitted
+def parse_encode_overrides(request_data):
+    overrides = {}
+    for field, (low, high) in ENCODE_OVERRIDE_FIELDS.items():
+        value = request_data.get(field)
+        if value is None:
+            continue
+        try:
+            overrides[field] = min(high, max(low, int(value)))
+        except (TypeError, ValueError):
+            raise ValueError(f"{field} must be an integer, got {value!r}")
+    return overrides
+
+class EncodeSettings:
+    def __init__(self, codec = "png", compress_level = 6, quality = 90):
+        self.codec = codec if codec in OUTPUT_CODECS else "png"
+        self.compress_level = int(compress_level)
+        self.quality = int(quality)
+
+    # request fields output_codec, output_compress_level and output_quality override these defaults
+    def with_overrides(self, request_data):
+        try:
+            overrides = parse_encode_overrides(request_data)
+        except ValueError:
+            overrides = {} # already rejected at admission, keep the node's settings rather than fail the render
+        return EncodeSettings(
+            request_data.get("output_codec", self.codec),
+            overrides.get("output_compress_level", self.compress_level),
+            overrides.get("output_quality", self.quality),
+        )
+
+def _cv2_color(img_np):
+    if img_np.ndim == 3 and img_np.shape[2] == 3:
+        return cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
+    if img_np.ndim == 3 and img_np.shape[2] == 4:
+        return cv2.cvtColor(img_np, cv2.COLOR_RGBA2BGRA)
+    return img_np
+
+def encode_image(img_np, settings):
+    if settings.codec == "png_cv2":
+        ok, buffer = cv2.imencode(".png", _cv2_color(img_np), [cv2.IMWRITE_PNG_COMPRESSION, min(9, max(0, settings.compress_level))])
+        if not ok:
+            raise ValueError("cv2 could not encode image as png")
+        return buffer
+    if settings.codec == "webp_cv2":
+        ok, buffer = cv2.imencode(".webp", _cv2_color(img_np), [cv2.IMWRITE_WEBP_QUALITY, min(101, max(1, settings.quality))])
+        if not ok:
+            raise ValueError("cv2 could not encode image as webp")
+        return buffer
     img_bytes = BytesIO()
-    Image.fromarray(img_np.squeeze()).save(img_bytes, format='PNG')
-    base64_image = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
+    if settings.codec == "webp_lossless":
+        Image.fromarray(img_np).save(img_bytes, format='WEBP', lossless=True, method=min(6, max(0, settings.compress_level)))
+    else:
+        Image.fromarray(img_np).save(img_bytes, format='PNG', compress_level=min(9, max(0, settings.compress_level)))
+    return img_bytes.getbuffer()
+
+def image_to_base64(image, settings = None):
+    started = time.perf_counter()
+    settings = settings or EncodeSettings()
+    img_np = (image.cpu().numpy() * 255).astype('uint8').squeeze()
+    encoded = encode_image(img_np, settings)
+    base64_image = base64.b64encode(encoded).decode('utf-8')
+    image_encode_seconds.observe(time.perf_counter() - started, (settings.codec,))
     return base64_image
 
-def images_to_base64(images):
-    base64_images = []
+# PNG compression in PIL/cv2 releases the GIL, so a batch encodes in parallel on a small pool
+# one pool, replaced when encode_workers changes, the old one finishes its work and exits
+DEFAULT_ENCODE_WORKERS = min(8, os.cpu_count() or 1)
+_encode_pool = None
+_encode_pool_workers = 0
+_encode_pool_lock = threading.Lock()
+
+def get_encode_pool(workers):
+    global _encode_pool, _encode_pool_workers
+    with _encode_pool_lock:
+        if _encode_pool is None or _encode_pool_workers != workers:
+            if _encode_pool is not None:
+                _encode_pool.shutdown(wait=False)
+            _encode_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="oop_encode")
+            _encode_pool_workers = workers
+        return _encode_pool
+
+# IMAGE inputs can be a batch tensor [B,H,W,C] or a list of them (INPUT_IS_LIST), flatten to single images
+def iter_single_images(images):
+    for image in images:
+        if image.dim() == 4:
+            yield from image
+        else:
+            yield image
+
+# base64 images in batch order
+def images_to_base64(images, workers = None, settings = None):
+    workers = DEFAULT_ENCODE_WORKERS if workers is None else max(1, int(workers))
+    images = list(iter_single_images(images))
+    if workers == 1 or len(images) <= 1:
+        return [image_to_base64(image, settings) for image in images]
+    pool = get_encode_pool(workers)
+    futures = []
     for image in images:
-        base64_image = image_to_base64(image)
-        base64_images.append(base64_image)
-    return base64_images
+        try:
+            future = pool.submit(image_to_base64, image, settings)
+        except RuntimeError:
+            # only submit raises this, when the pool was replaced by a settings change, the rest goes to the new one
+            pool = get_encode_pool(workers)
+            future = pool.submit(image_to_base64, image, settings)
+        futures.append(future)
+    # encode errors are raised here as is
+    return [future.result() for future in futures]
+
+# checkpoint switch patterns are the same on every run, compile once
+# invalid patterns are cached as None instead of raising re.error every time
+@lru_cache(maxsize=256)
+def compile_pattern(pattern):
+    try:
+        return re.compile(pattern)
+    except re.error:
+        return None
+
+
+PREVIEW_FORMATS = ["PNG", "JPEG", "WEBP"]
 
-def preview_to_base64(image):
+def preview_to_base64(image, format = "PNG", quality = 95):
+    started = time.perf_counter()
     img_bytes = BytesIO()
-    image.save(img_bytes, format="PNG", quality=95)
+    if format == "JPEG" and image.mode != "RGB":
+        image = image.convert("RGB")
+    image.save(img_bytes, format=format, quality=quality)
     base64_image = base64.b64encode(img_bytes.getvalue()).decode('utf-8')
+    preview_encodes_total.inc(labels=(format,))
+    preview_encode_seconds.observe(time.perf_counter() - started, (format,))
     return base64_image
 
 import json